@@ -0,0 +1,936 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the flake8 string format checker."""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import ast
+import codecs
+import gc
+import itertools
+import json
+import os
+import py_compile
+import random
+import subprocess
+import sys
+
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import flake8_string_format
+
+
+def generate_source(literals, density, seed=0):
+    """
+    Generate a module with the given number of string literals.
+
+    The density is the fraction of literals which contain replacement fields.
+    The rest are plain strings and docstrings which are the most common
+    literals in real code.
+    """
+    rand = random.Random(seed)
+    code = ['"""Generated module."""', '']
+    for index in range(literals):
+        with_fields = rand.random() < density
+        kind = index % 4
+        if kind == 0:
+            code += ['def function_{0}(value):'.format(index)]
+            if with_fields:
+                code += ['    """Return {{0}} for {0}."""'.format(index)]
+            else:
+                code += ['    """Return the value for {0}."""'.format(index)]
+            code += ['    return value', '']
+        elif kind == 1:
+            if with_fields:
+                code += ['value_{0} = "entry {{0}} of {{1}}".format({0}, 1)'
+                         .format(index)]
+            else:
+                code += ['value_{0} = "plain entry number {0}"'.format(index)]
+        elif kind == 2:
+            if with_fields:
+                code += ['message_{0} = "{{name}} did {{0}}"'.format(index)]
+            else:
+                code += ['message_{0} = b"binary \\x00 data"'.format(index)]
+        else:
+            if with_fields:
+                code += ['print(str.format("{{}} and {{}}", {0}, 2))'
+                         .format(index)]
+            else:
+                code += ['print("some output", {0})'.format(index)]
+    return '\n'.join(code) + '\n'
+
+
+def best_time(func, repeat):
+    """Return the fastest of several runs of the function."""
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def parse_fields(string):
+    """
+    Return the fields of the string like the checker before the scanner.
+
+    It parses the format spec of every field for nested fields. It's the
+    reference which the scanner of the checker is compared with.
+    """
+    fields = set()
+    cnt = itertools.count()
+    implicit = False
+    explicit = False
+    formatter = flake8_string_format.StringFormatChecker._FORMATTER
+    try:
+        for literal, field, spec, conv in formatter.parse(string):
+            if field is not None and (
+                    conv is None or
+                    conv in flake8_string_format._CONVERSIONS):
+                if not field:
+                    field = str(next(cnt))
+                    implicit = True
+                else:
+                    explicit = True
+                fields.add(field)
+                fields.update(parsed_spec[1]
+                              for parsed_spec in formatter.parse(spec)
+                              if parsed_spec[1] is not None)
+    except ValueError:
+        return set(), False, False
+    else:
+        return fields, implicit, explicit
+
+
+class UnfilteredChecker(flake8_string_format.StringFormatChecker):
+
+    """Checker which parses every literal, even if it has no braces."""
+
+    def get_fields(self, string):
+        return parse_fields(string)
+
+
+def collect_texts(tree):
+    """Return the text of all literals the checker would parse."""
+    visitor = flake8_string_format.TextVisitor()
+    visitor.visit(tree)
+    texts = []
+    for literal in visitor.literals:
+        text = literal.value
+        if isinstance(text, bytes):
+            text = text.decode('ascii', 'replace')
+        texts.append(text)
+    return texts
+
+
+def bench_prefilter(args):
+    """Compare the checker with and without the brace pre-filter."""
+    print('{0:>8} {1:>8} {2:>12} {3:>12} {4:>8} {5:>12} {6:>12} {7:>8}'
+          .format('literals', 'density', 'parse all', 'pre-filter',
+                  'speedup', 'file all', 'file filter', 'speedup'))
+    for density in args.densities:
+        tree = ast.parse(generate_source(args.literals, density))
+        texts = collect_texts(tree)
+        parse_timings = []
+        file_timings = []
+        for checker in (UnfilteredChecker,
+                        flake8_string_format.StringFormatChecker):
+            get_fields = checker(tree, 'bench').get_fields
+            parse_timings.append(best_time(
+                lambda: [get_fields(text) for text in texts], args.repeat))
+            file_timings.append(best_time(
+                lambda: list(checker(tree, 'bench').run()), args.repeat))
+        print('{0:>8} {1:>8.2f} {2:>10.2f}ms {3:>10.2f}ms {4:>7.2f}x '
+              '{5:>10.2f}ms {6:>10.2f}ms {7:>7.2f}x'.format(
+                  args.literals, density,
+                  parse_timings[0] * 1000, parse_timings[1] * 1000,
+                  parse_timings[0] / parse_timings[1],
+                  file_timings[0] * 1000, file_timings[1] * 1000,
+                  file_timings[0] / file_timings[1]))
+
+
+def load_corpus(args):
+    """Return a list of (name, source) tuples to benchmark."""
+    corpus = []
+    for index in range(args.files):
+        corpus.append(('generated_{0}.py'.format(index),
+                       generate_source(args.literals, args.density,
+                                       seed=index)))
+    for path in args.paths:
+        if os.path.isdir(path):
+            filenames = sorted(
+                os.path.join(root, filename)
+                for root, _, filenames in os.walk(path)
+                for filename in filenames if filename.endswith('.py'))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            with codecs.open(filename, 'r', 'utf-8') as f:
+                corpus.append((filename, f.read()))
+    return corpus
+
+
+def reset_parse_cache():
+    """Start with an empty cache so every repetition parses the same."""
+    checker = flake8_string_format.StringFormatChecker
+    checker._parse_cache = flake8_string_format._LRUCache(
+        checker._parse_cache.max_size)
+    checker._field_kinds_cache = flake8_string_format._LRUCache(
+        checker._field_kinds_cache.max_size)
+    checker._call_cache = flake8_string_format._LRUCache(
+        checker._call_cache.max_size)
+
+
+def measure_phases(trees, repeat):
+    """Return the timings of each phase of checking all trees."""
+    checker = flake8_string_format.StringFormatChecker
+    texts = [text for tree in trees for text in collect_texts(tree)]
+
+    def traverse():
+        for tree in trees:
+            flake8_string_format.TextVisitor().visit(tree)
+
+    def parse():
+        reset_parse_cache()
+        get_fields = checker(None, 'bench').get_fields
+        for text in texts:
+            get_fields(text)
+
+    def run():
+        reset_parse_cache()
+        for tree in trees:
+            list(checker(tree, 'bench').run())
+
+    return {
+        'traverse': best_time(traverse, repeat),
+        'parse': best_time(parse, repeat),
+        'run': best_time(run, repeat),
+        'literals': len(texts),
+    }
+
+
+def measure_peak_memory(trees):
+    """Return the peak memory allocated while checking the trees."""
+    if tracemalloc is None:
+        return None
+    reset_parse_cache()
+    tracemalloc.start()
+    try:
+        for tree in trees:
+            list(flake8_string_format.StringFormatChecker(tree, 'bench').run())
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def compare_baseline(metrics, baseline, tolerance):
+    """Return a list of the metrics which are slower than the baseline."""
+    regressions = []
+    for name in ('traverse', 'parse', 'run', 'peak_memory'):
+        if metrics.get(name) is None or baseline.get(name) is None:
+            continue
+        if metrics[name] > baseline[name] * (1 + tolerance):
+            regressions.append('{0}: {1:.4g} > {2:.4g} (+{3:.0%})'.format(
+                name, metrics[name], baseline[name],
+                metrics[name] / baseline[name] - 1))
+    return regressions
+
+
+def bench_suite(args):
+    """Measure the throughput of each phase over a corpus of files."""
+    corpus = load_corpus(args)
+    trees = [ast.parse(source) for _, source in corpus]
+    metrics = measure_phases(trees, args.repeat)
+    metrics['files'] = len(trees)
+    metrics['peak_memory'] = measure_peak_memory(trees)
+
+    print('{0} files with {1} literals'.format(metrics['files'],
+                                               metrics['literals']))
+    for phase in ('traverse', 'parse', 'run'):
+        print('{0:>10}: {1:10.2f}ms {2:12.1f} files/s {3:12.1f} literals/s'
+              .format(phase, metrics[phase] * 1000,
+                      metrics['files'] / metrics[phase],
+                      metrics['literals'] / metrics[phase]))
+    if metrics['peak_memory'] is not None:
+        print('peak memory: {0:.1f} KiB'.format(
+            metrics['peak_memory'] / 1024.0))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(metrics, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get('files'), baseline.get('literals')) != (
+                metrics['files'], metrics['literals']):
+            print('Warning: The baseline was measured on a different corpus')
+        regressions = compare_baseline(metrics, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression in ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+class NodeCollector(ast.NodeVisitor):
+
+    """Collector which keeps the nodes like the visitor used to."""
+
+    def __init__(self):
+        self.nodes = []
+        self.calls = {}
+
+    def visit_Str(self, node):
+        self.nodes.append(node)
+
+    visit_Bytes = visit_Str
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, (str, bytes)):
+            self.nodes.append(node)
+
+    def visit_Call(self, node):
+        if (isinstance(node.func, ast.Attribute) and
+                node.func.attr == 'format'):
+            self.calls[node.func.value] = node
+        self.generic_visit(node)
+
+
+def measure_retained(source, collector):
+    """
+    Return the memory still allocated after the tree has been released.
+
+    The source is parsed and traversed with the collector, then the tree is
+    deleted and only what the collector refers to survives.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tree = ast.parse(source)
+        tree_size = tracemalloc.get_traced_memory()[0]
+        collected = collector(tree)
+        del tree
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+        del collected
+        return tree_size, retained
+    finally:
+        tracemalloc.stop()
+
+
+def collect_nodes(tree):
+    collector = NodeCollector()
+    collector.visit(tree)
+    return collector
+
+
+def collect_records(tree):
+    visitor = flake8_string_format.TextVisitor()
+    visitor.visit(tree)
+    return visitor
+
+
+def check_collected(tree):
+    """Check the tree after collecting all strings first."""
+    checker = flake8_string_format.StringFormatChecker(tree, 'bench')
+    for literal in collect_records(tree).literals:
+        for _ in checker._check_literal(literal):
+            pass
+
+
+def check_streamed(tree):
+    """Check each string as soon as it is reached."""
+    for _ in flake8_string_format.StringFormatChecker(tree, 'bench').run():
+        pass
+
+
+def measure_check_peak(tree, check):
+    """Return the peak memory allocated by the check besides the tree."""
+    reset_parse_cache()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        check(tree)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    """Compare the memory used by nodes, records and streaming."""
+    if tracemalloc is None:
+        print('The memory benchmark requires tracemalloc')
+        return 1
+    print('{0:>8} {1:>10} {2:>12} {3:>12} {4:>12} {5:>8} {6:>12} {7:>12}'
+          .format('literals', 'source', 'tree', 'nodes', 'records', 'saving',
+                  'collect peak', 'stream peak'))
+    for literals in args.literals:
+        source = generate_source(literals, args.density)
+        tree_size, nodes = measure_retained(source, collect_nodes)
+        _, records = measure_retained(source, collect_records)
+        tree = ast.parse(source)
+        collected = measure_check_peak(tree, check_collected)
+        streamed = measure_check_peak(tree, check_streamed)
+        del tree
+        print('{0:>8} {1:>8.1f}MB {2:>10.1f}MB {3:>10.1f}MB {4:>10.1f}MB '
+              '{5:>7.1f}x {6:>10.1f}MB {7:>10.1f}MB'.format(
+                  literals, len(source) / 1048576.0, tree_size / 1048576.0,
+                  nodes / 1048576.0, records / 1048576.0,
+                  float(nodes) / records if records else float('inf'),
+                  collected / 1048576.0, streamed / 1048576.0))
+    return 0
+
+
+def generate_calls(calls, seed=0):
+    """Generate a module which consists only of calls to format."""
+    rand = random.Random(seed)
+    code = []
+    for index in range(calls):
+        kind = rand.randrange(4)
+        if kind == 0:
+            code += ['"{{0}} {{1}}".format({0}, 1)'.format(index)]
+        elif kind == 1:
+            code += ['"{{name}}".format(name={0})'.format(index)]
+        elif kind == 2:
+            code += ['b"{{0}}".format(*args_{0})'.format(index)]
+        else:
+            code += ['str.format("{{}}", {0}, **kwargs)'.format(index)]
+    return '\n'.join(code) + '\n'
+
+
+def runtime_is_base_string(node):
+    """Check for strings like before the dispatch was done at import."""
+    typ = (ast.Str,)
+    if sys.version_info[0] > 2:
+        typ += (ast.Bytes,)
+    return isinstance(node, typ)
+
+
+def runtime_call_args(call, str_args):
+    """Get the arguments like before the dispatch was done at import."""
+    keywords = frozenset(keyword.arg for keyword in call.keywords)
+    num_args = len(call.args)
+    if str_args:
+        num_args -= 1
+    if sys.version_info < (3, 5):
+        has_kwargs = bool(call.kwargs)
+        has_starargs = bool(call.starargs)
+    else:
+        has_kwargs = None in keywords
+        has_starargs = sum(1 for arg in call.args
+                           if isinstance(arg, ast.Starred))
+        if has_kwargs:
+            keywords = keywords - frozenset([None])
+        if has_starargs:
+            num_args -= has_starargs
+    if sys.version_info[:3] == (3, 4, 2):
+        position = call.func.value.lineno, call.func.value.col_offset
+    else:
+        position = call.lineno, call.col_offset
+    return position, num_args, keywords, has_starargs, has_kwargs
+
+
+def runtime_string(text, is_format):
+    """Decode bytes like before the dispatch was done at import."""
+    if sys.version_info[0] > 2 and isinstance(text, bytes):
+        if b'{' not in text and not is_format:
+            return None
+        try:
+            return text.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    return text
+
+
+def bench_dispatch(args):
+    """Compare the per call cost of dispatching at runtime and at import."""
+    module = flake8_string_format
+    tree = ast.parse(generate_calls(args.calls))
+    calls = [node for node in ast.walk(tree) if isinstance(node, ast.Call)]
+    receivers = [(call.func.value, call.args[0] if call.args else None)
+                 for call in calls]
+    texts = [module._get_text(call.func.value)
+             if module._is_base_string(call.func.value)
+             else module._get_text(call.args[0]) for call in calls]
+
+    def runtime():
+        for call, (receiver, first) in zip(calls, receivers):
+            if runtime_is_base_string(receiver):
+                runtime_call_args(call, False)
+            elif runtime_is_base_string(first):
+                runtime_call_args(call, True)
+        for text in texts:
+            runtime_string(text, True)
+
+    get_string = module.StringFormatChecker(None, 'bench')._get_string
+
+    def dispatched():
+        for call, (receiver, first) in zip(calls, receivers):
+            if module._is_base_string(receiver):
+                module._FormatCall(call, False)
+            elif module._is_base_string(first):
+                module._FormatCall(call, True)
+        for text in texts:
+            get_string(text, True)
+
+    print('{0:>8} {1:>14} {2:>14} {3:>8}'.format(
+        'calls', 'runtime', 'import', 'speedup'))
+    timings = [best_time(func, args.repeat) for func in (runtime, dispatched)]
+    print('{0:>8} {1:>11.0f}ns {2:>11.0f}ns {3:>7.2f}x'.format(
+        len(calls), timings[0] / len(calls) * 1e9,
+        timings[1] / len(calls) * 1e9, timings[0] / timings[1]))
+    return 0
+
+
+# Common configurations as the select and ignore options of Flake8
+CONFIGURATIONS = [
+    ('all', None, None),
+    ('--ignore FMT101,FMT102,FMT103', None, 'FMT101,FMT102,FMT103'),
+    ('--ignore FMT102,FMT103', None, 'FMT102,FMT103'),
+    ('--select FMT2', 'FMT2', None),
+    ('--select FMT1', 'FMT1', None),
+]
+
+
+def bench_prune(args):
+    """Compare checking with all codes and with common configurations."""
+    checker = flake8_string_format.StringFormatChecker
+    trees = [ast.parse(generate_source(args.literals, args.density, seed))
+             for seed in range(args.files)]
+    enabled_codes = checker._enabled_codes
+
+    def run():
+        reset_parse_cache()
+        for tree in trees:
+            list(checker(tree, 'bench').run())
+
+    print('{0:<32} {1:>12} {2:>8}'.format('configuration', 'run', 'speedup'))
+    baseline = None
+    try:
+        for name, select, ignore in CONFIGURATIONS:
+            options = argparse.Namespace(select=select, ignore=ignore)
+            checker._enabled_codes = flake8_string_format._get_enabled_codes(
+                options)
+            timing = best_time(run, args.repeat)
+            baseline = baseline or timing
+            print('{0:<32} {1:>10.2f}ms {2:>7.2f}x'.format(
+                name, timing * 1000, baseline / timing))
+    finally:
+        checker._enabled_codes = enabled_codes
+    return 0
+
+
+# Pieces of the generated templates with many fields
+TEMPLATE_PIECES = ['{0} ', '{} ', '{name!r:>10} ', '{1:{width}} ',
+                   '{x.y[0]} ', '{{escaped}} ', 'some text ']
+
+
+def generate_template(fields, seed=0):
+    """Generate a template which consists of the given number of pieces."""
+    rand = random.Random(seed)
+    return ''.join(rand.choice(TEMPLATE_PIECES) for _ in range(fields))
+
+
+def bench_scan(args):
+    """Compare the single pass scanner with parsing the format specs."""
+    checker = flake8_string_format.StringFormatChecker(None, 'bench')
+    print('{0:>8} {1:>12} {2:>12} {3:>8}'.format(
+        'fields', 'parse', 'scan', 'speedup'))
+    for fields in args.fields:
+        templates = [generate_template(fields, seed)
+                     for seed in range(args.templates)]
+        timings = [best_time(lambda: [func(template)
+                                      for template in templates], args.repeat)
+                   for func in (parse_fields, checker._scan_fields)]
+        print('{0:>8} {1:>10.2f}ms {2:>10.2f}ms {3:>7.2f}x'.format(
+            fields, timings[0] * 1000, timings[1] * 1000,
+            timings[0] / timings[1]))
+    return 0
+
+
+# Pieces of the random templates of the fuzzer
+FUZZ_NAMES = ['', '', '0', '12', 'name', 'a.b', 'a[0]', 'a[!:]', '\xe4\xdf',
+              ' ']
+FUZZ_TEXTS = ['text', ' ', '\u20ac', '\u30de', '\U0001f600', '\n', '!', ':',
+              '[', ']', '.']
+FUZZ_MALFORMED = ['{', '}', '{0', '{!', '{0!}', '{0!rs}', '{:', '{0:{', '{[',
+                  '{0[}', '{0:{{}}}']
+
+
+def generate_fuzz_field(rand, depth):
+    """Generate a replacement field with random conversion and format spec."""
+    field = '{' + rand.choice(FUZZ_NAMES)
+    if rand.random() < 0.3:
+        field += '!' + rand.choice('rsaxr')
+    if rand.random() < 0.5 / (1 + 4 * depth):
+        field += ':' + generate_fuzz_template(rand, rand.randrange(4),
+                                              depth + 1)
+    return field + '}'
+
+
+def generate_fuzz_template(rand, pieces, depth=0):
+    """
+    Generate a random template from the given number of pieces.
+
+    The pieces are text, escaped braces, replacement fields with nested
+    fields in their format spec and malformed braces. Some pieces are repeated
+    many times to generate very long templates.
+    """
+    template = []
+    for _ in range(pieces):
+        kind = rand.random()
+        if kind < 0.3:
+            piece = rand.choice(FUZZ_TEXTS)
+        elif kind < 0.45:
+            piece = rand.choice(['{{', '}}'])
+        elif kind < 0.9:
+            if depth > 2:
+                piece = rand.choice(FUZZ_TEXTS)
+            else:
+                piece = generate_fuzz_field(rand, depth)
+        elif kind < 0.98:
+            piece = rand.choice(['>10', '.{0}f', '{}'])
+        else:
+            piece = rand.choice(FUZZ_MALFORMED)
+        if rand.random() < 0.02:
+            piece *= rand.randrange(100, 2000)
+        template.append(piece)
+    return ''.join(template)
+
+
+def fuzz_once(checker, template, repeat):
+    """Return the comparison of the scanner and the reference on a template."""
+    try:
+        list(checker._FORMATTER.parse(template))
+    except ValueError:
+        error = True
+    else:
+        error = False
+    expected = parse_fields(template)
+    actual = checker._scan_fields(template)
+    fields = checker.get_fields(template)
+    match = (actual == expected and
+             fields == (frozenset(expected[0]),) + expected[1:] and
+             (not error or expected == (set(), False, False)))
+    return {
+        'template': template,
+        'length': len(template),
+        'error': error,
+        'match': match,
+        'parse': best_time(lambda: parse_fields(template), repeat),
+        'scan': best_time(lambda: checker._scan_fields(template), repeat),
+    }
+
+
+def ascii_repr(text):
+    """Return the representation of the text in ASCII for any stdout."""
+    # The representation on Python 2 is already in ASCII
+    return ascii(text) if sys.version_info[0] > 2 else repr(text)
+
+
+def speedup(reference_time, time):
+    """Return how much faster than the reference it is, even if too fast."""
+    # The timer of Python 2 on some systems is too coarse for one template
+    return reference_time / time if time else float('inf')
+
+
+def bench_fuzz(args):
+    """Compare the scanner with the reference on random templates."""
+    reset_parse_cache()
+    checker = flake8_string_format.StringFormatChecker(None, 'bench')
+    rand = random.Random(args.seed)
+    results = [fuzz_once(checker, generate_fuzz_template(
+        rand, rand.randrange(1, args.pieces + 1)), args.repeat)
+        for _ in range(args.templates)]
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    mismatches = [result for result in results if not result['match']]
+    parse_time = sum(result['parse'] for result in results)
+    scan_time = sum(result['scan'] for result in results)
+    print('{0:>10} {1:>8} {2:>10} {3:>12} {4:>12} {5:>8}'.format(
+        'templates', 'errors', 'mismatches', 'parse', 'scan', 'speedup'))
+    print('{0:>10} {1:>8} {2:>10} {3:>10.2f}ms {4:>10.2f}ms {5:>7.2f}x'.format(
+        len(results), sum(result['error'] for result in results),
+        len(mismatches), parse_time * 1000, scan_time * 1000,
+        speedup(parse_time, scan_time)))
+    print()
+    print('Slowest templates compared to the reference:')
+    for result in sorted(results, key=lambda result: speedup(
+            result['parse'], result['scan']))[:args.show]:
+        print('{0:>7.2f}x {1:>8} {2}'.format(
+            speedup(result['parse'], result['scan']), result['length'],
+            ascii_repr(result['template'][:60])))
+    for result in mismatches[:args.show]:
+        print('Mismatch: {0}'.format(ascii_repr(result['template'])),
+              file=sys.stderr)
+
+    failed = bool(mismatches)
+    if scan_time > parse_time * (1 + args.tolerance):
+        print('The scanner is slower than the reference: {0:.4g} > {1:.4g}'
+              .format(scan_time, parse_time), file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+def parse_importtime(output, module):
+    """
+    Return the timings of the module in the output of ``-X importtime``.
+
+    It returns the self and cumulative time of the module in microseconds and
+    a dict with the cumulative time of each module it imported.
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not self_time.strip().isdigit():
+            # The header of the columns
+            continue
+        depth = len(name) - len(name.lstrip())
+        entries.append((name.strip(), depth, int(self_time),
+                        int(cumulative)))
+    for index, (name, depth, self_time, cumulative) in enumerate(entries):
+        if name != module:
+            continue
+        # The imports of a module are listed before it and indented deeper
+        imports = {}
+        for child, child_depth, _, child_cumulative in reversed(
+                entries[:index]):
+            if child_depth <= depth:
+                break
+            if child_depth == depth + 2:
+                imports[child] = child_cumulative
+        return self_time, cumulative, imports
+    return None
+
+
+def measure_import(module, preload):
+    """Import the module in a new interpreter and return its timings."""
+    statements = ['import {0}'.format(name) for name in preload]
+    statements.append('import {0}'.format(module))
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', '; '.join(statements)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError(stderr.decode('utf-8', 'replace'))
+    return parse_importtime(stderr.decode('utf-8', 'replace'), module)
+
+
+def bench_importtime(args):
+    """Measure the time to import the plugin in a new interpreter."""
+    if sys.version_info < (3, 7):
+        print('-X importtime requires Python 3.7 or newer', file=sys.stderr)
+        return 2
+    module = flake8_string_format.__name__
+    # Compiling the module once, so that it isn't measured in the first run
+    py_compile.compile(flake8_string_format.__file__)
+    timings = sorted((measure_import(module, args.preload)
+                      for _ in range(args.repeat)),
+                     key=lambda timing: timing[1])
+    self_time, cumulative, imports = timings[len(timings) // 2]
+    print('{0:>12} {1:>12} {2:>8}'.format('self', 'cumulative', 'imports'))
+    print('{0:>10.2f}ms {1:>10.2f}ms {2:>8}'.format(
+        self_time / 1000.0, cumulative / 1000.0, len(imports)))
+    if imports:
+        print()
+        print('Slowest imports of the plugin:')
+        for name, time in sorted(imports.items(), key=lambda item: -item[1])[
+                :args.show]:
+            print('{0:>10.2f}ms {1}'.format(time / 1000.0, name))
+    return 0
+
+
+def bench_shard(args):
+    """Compare checking a large module in one process and in shards."""
+    checker = flake8_string_format.StringFormatChecker
+    print('{0:>8} {1:>8} {2:>12} {3:>12} {4:>8} {5:>10}'.format(
+        'literals', 'lines', 'serial', 'sharded', 'speedup', 'identical'))
+    try:
+        checker._shard_jobs = args.jobs
+        for literals in args.literals:
+            source = generate_source(literals, args.density)
+            lines = source.splitlines(True)
+            tree = ast.parse(source)
+            timings = []
+            results = []
+            for shard_lines in (0, args.shard_lines):
+                checker._shard_lines = shard_lines
+
+                def run():
+                    reset_parse_cache()
+                    results.append(list(checker(tree, 'bench', lines).run()))
+                timings.append(best_time(run, args.repeat))
+            print('{0:>8} {1:>8} {2:>10.2f}ms {3:>10.2f}ms {4:>7.2f}x '
+                  '{5:>10}'.format(
+                      literals, len(lines), timings[0] * 1000,
+                      timings[1] * 1000, timings[0] / timings[1],
+                      'yes' if results[0] == results[-1] else 'NO'))
+    finally:
+        checker._shard_lines = 0
+        checker._shard_jobs = None
+    return 0
+
+
+def bench_calls(args):
+    """Compare checking format calls with and without caching their errors."""
+    checker = flake8_string_format.StringFormatChecker
+    trees = [ast.parse(generate_calls(args.calls, seed))
+             for seed in range(args.files)]
+    call_cache = checker._call_cache
+
+    def run():
+        reset_parse_cache()
+        for tree in trees:
+            list(checker(tree, 'bench').run())
+
+    print('{0:>10} {1:>12} {2:>8} {3:>10}'.format(
+        'cache size', 'run', 'speedup', 'hit rate'))
+    baseline = None
+    try:
+        for size in [0] + args.sizes:
+            checker._call_cache = flake8_string_format._LRUCache(size)
+            timing = best_time(run, args.repeat)
+            baseline = baseline or timing
+            # The counters of the last repetition
+            cache = checker._call_cache
+            lookups = cache.hits + cache.misses
+            print('{0:>10} {1:>10.2f}ms {2:>7.2f}x {3:>9.1%}'.format(
+                size, timing * 1000, baseline / timing,
+                float(cache.hits) / lookups if lookups else 0))
+    finally:
+        checker._call_cache = call_cache
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    prefilter = subparsers.add_parser(
+        'prefilter', help=bench_prefilter.__doc__)
+    prefilter.add_argument('--literals', type=int, default=20000)
+    prefilter.add_argument('--densities', type=float, nargs='+',
+                           default=[0.0, 0.1, 0.5, 1.0])
+    prefilter.add_argument('--repeat', type=int, default=3)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    memory = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--literals', type=int, nargs='+',
+                        default=[20000, 100000, 200000],
+                        help='number of literals in each generated module')
+    memory.add_argument('--density', type=float, default=0.3,
+                        help='fraction of generated literals with fields')
+    memory.set_defaults(func=bench_memory)
+
+    dispatch = subparsers.add_parser('dispatch', help=bench_dispatch.__doc__)
+    dispatch.add_argument('--calls', type=int, default=20000,
+                          help='number of format calls in the module')
+    dispatch.add_argument('--repeat', type=int, default=5)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    prune = subparsers.add_parser('prune', help=bench_prune.__doc__)
+    prune.add_argument('--files', type=int, default=10,
+                       help='number of generated files')
+    prune.add_argument('--literals', type=int, default=2000,
+                       help='number of literals in each generated file')
+    prune.add_argument('--density', type=float, default=0.3,
+                       help='fraction of generated literals with fields')
+    prune.add_argument('--repeat', type=int, default=5)
+    prune.set_defaults(func=bench_prune)
+
+    scan = subparsers.add_parser('scan', help=bench_scan.__doc__)
+    scan.add_argument('--fields', type=int, nargs='+',
+                      default=[2, 10, 100, 1000],
+                      help='number of pieces in each generated template')
+    scan.add_argument('--templates', type=int, default=200,
+                      help='number of generated templates')
+    scan.add_argument('--repeat', type=int, default=5)
+    scan.set_defaults(func=bench_scan)
+
+    fuzz = subparsers.add_parser('fuzz', help=bench_fuzz.__doc__)
+    fuzz.add_argument('--templates', type=int, default=5000,
+                      help='number of random templates')
+    fuzz.add_argument('--pieces', type=int, default=30,
+                      help='maximum number of pieces in each template')
+    fuzz.add_argument('--seed', type=int, default=0)
+    fuzz.add_argument('--repeat', type=int, default=3)
+    fuzz.add_argument('--show', type=int, default=5,
+                      help='number of slowest templates and mismatches shown')
+    fuzz.add_argument('--output', metavar='FILE',
+                      help='store the timings of each template as JSON lines')
+    fuzz.add_argument('--tolerance', type=float, default=0.2,
+                      help='allowed slowdown compared to the reference')
+    fuzz.set_defaults(func=bench_fuzz)
+
+    importtime = subparsers.add_parser('importtime',
+                                       help=bench_importtime.__doc__)
+    importtime.add_argument('--repeat', type=int, default=11,
+                            help='number of new interpreters, the median is '
+                                 'reported')
+    importtime.add_argument('--preload', nargs='*', default=[],
+                            metavar='MODULE',
+                            help='modules imported before the plugin, like '
+                                 'flake8.main.cli to only measure the '
+                                 'additional cost')
+    importtime.add_argument('--show', type=int, default=10,
+                            help='number of the slowest imports shown')
+    importtime.set_defaults(func=bench_importtime)
+
+    shard = subparsers.add_parser('shard', help=bench_shard.__doc__)
+    shard.add_argument('--literals', type=int, nargs='+',
+                       default=[20000, 100000],
+                       help='number of literals in each generated module')
+    shard.add_argument('--density', type=float, default=0.3,
+                       help='fraction of generated literals with fields')
+    shard.add_argument('--shard-lines', type=int, default=20000,
+                       help='number of lines in each shard')
+    shard.add_argument('--jobs', type=int, default=None,
+                       help='number of processes (default: number of CPUs)')
+    shard.add_argument('--repeat', type=int, default=3)
+    shard.set_defaults(func=bench_shard)
+
+    calls = subparsers.add_parser('calls', help=bench_calls.__doc__)
+    calls.add_argument('--files', type=int, default=10,
+                       help='number of generated files')
+    calls.add_argument('--calls', type=int, default=2000,
+                       help='number of format calls in each generated file')
+    calls.add_argument('--sizes', type=int, nargs='+', default=[2, 4096],
+                       help='sizes of the cache of the errors of calls')
+    calls.add_argument('--repeat', type=int, default=5)
+    calls.set_defaults(func=bench_calls)
+
+    suite = subparsers.add_parser('suite', help=bench_suite.__doc__)
+    suite.add_argument('--files', type=int, default=10,
+                       help='number of generated files')
+    suite.add_argument('--literals', type=int, default=2000,
+                       help='number of literals in each generated file')
+    suite.add_argument('--density', type=float, default=0.3,
+                       help='fraction of generated literals with fields')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--save-baseline', metavar='FILE',
+                       help='store the results as the new baseline')
+    suite.add_argument('--baseline', metavar='FILE',
+                       help='fail if it is slower than this baseline')
+    suite.add_argument('--tolerance', type=float, default=0.2,
+                       help='allowed slowdown compared to the baseline')
+    suite.add_argument('paths', nargs='*',
+                       help='additional files or directories to check')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,113 +4,1157 @@
 from __future__ import print_function, unicode_literals
 
 import ast
-import itertools
+import atexit
+import codecs
+import errno
+import functools
+import gc
+import io
+import os
 import re
 import sys
+import tokenize
 
+from collections import OrderedDict, namedtuple
+from keyword import iskeyword
 from string import Formatter
+from timeit import default_timer
 
 
 __version__ = '0.3.0'
 
+STATISTICS_ENV = 'FLAKE8_STRING_FORMAT_STATS'
 
-class TextVisitor(ast.NodeVisitor):
+# Python 2 byte strings with non-ASCII characters can't be compared to or
+# joined with unicode literals, so these are native strings which work with
+# strings of either type
+_EMPTY = str('')
+_SPACE = str(' ')
+_NEWLINE = str('\n')
+_DOT = str('.')
+_COLON = str(':')
+_OPEN_BRACE = str('{')
+_OPEN_BRACKET = str('[')
+_CLOSE_BRACKET = str(']')
+_CONVERSIONS = str('rsa')
 
+
+def _register_opt(parser, *args, **kwargs):
+    """Register an option with Flake8 3.x or newer and fall back to 2.x."""
+    try:
+        parser.add_option(*args, **kwargs)
+    except Exception as e:
+        # Flake8 2.x uses a plain optparse parser, so it's already imported
+        import optparse
+        if not isinstance(e, (TypeError, optparse.OptionError)):
+            raise
+        parse_from_config = kwargs.pop('parse_from_config', False)
+        parser.add_option(*args, **kwargs)
+        if parse_from_config:
+            parser.config_options.append(args[-1].lstrip('-'))
+
+
+def _split_codes(value):
+    """Return the list of codes from a comma separated string or a list."""
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        value = ','.join(value)
+    return [code.strip() for code in value.split(',') if code.strip()]
+
+
+def _longest_prefix(code, prefixes):
+    return max([len(prefix) for prefix in prefixes
+                if code.startswith(prefix)] or [-1])
+
+
+def _get_enabled_codes(options):
     """
-    Node visitor for bytes and str instances.
+    Return the FMT codes which Flake8 will report with the given options.
 
-    It tries to detect docstrings as string of the first expression of each
-    module, class or function.
+    This only considers the global select and ignore settings so that a code
+    is only regarded as disabled when Flake8 would discard it in any file.
+    """
+    select = _split_codes(getattr(options, 'select', None))
+    extend_select = _split_codes(getattr(options, 'extend_select', None))
+    ignore = (_split_codes(getattr(options, 'ignore', None)) +
+              _split_codes(getattr(options, 'extend_ignore', None)))
+    # Flake8 3.x always sets this default which implicitly selects all
+    # plugins, so it does not count as an explicit selection
+    explicit_select = bool(select) and set(select) != set(['E', 'F', 'W',
+                                                           'C90'])
+    enabled = set()
+    for code in StringFormatChecker.ERRORS:
+        name = 'FMT{0}'.format(code)
+        selected = _longest_prefix(name, select + extend_select)
+        if selected < 0 and not explicit_select:
+            selected = 0
+        if selected >= 0 and selected >= _longest_prefix(name, ignore):
+            enabled.add(code)
+    return frozenset(enabled)
+
+
+class _LRUCache(object):
+
+    """
+    Mapping of a bounded size which drops the least recently used entries.
+
+    It counts how often a lookup found an entry (``hits``) and how often not
+    (``misses``). A cache with a maximum size of zero doesn't store anything.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the value for the key or None if it is not cached."""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinsert it as the most recently used entry
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store the value and drop the least recently used if necessary."""
+        if self.max_size <= 0:
+            return
+        self._data[key] = value
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class _ResultCache(object):
+
+    """
+    On-disk cache for the results of previously checked sources.
+
+    Every entry is stored in a separate file named after the key. Entries are
+    written to a temporary file first and then renamed, so that concurrent
+    worker processes either see a complete entry or none. The modification
+    time of an entry is updated whenever it is read. Listing the directory
+    takes linear time, so only about every tenth of ``max_entries`` writes
+    removes the least recently used entries down to nine tenths of
+    ``max_entries``.
     """
 
+    SUFFIX = '.json'
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.evict_interval = max(1, max_entries // 10)
+
+    @staticmethod
+    def key(source, codes):
+        """Return the key for the source checked for the enabled codes."""
+        import hashlib
+        import platform
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8', 'backslashreplace')
+        digest = hashlib.sha256(__version__.encode('ascii'))
+        # The positions of the errors depend on the interpreter
+        digest.update('{0} {1}.{2}'.format(
+            platform.python_implementation(),
+            *sys.version_info[:2]).encode('ascii'))
+        digest.update(','.join(str(code) for code in sorted(codes))
+                      .encode('ascii'))
+        digest.update(b'\0')
+        digest.update(source)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """Return the stored results or None if there are none."""
+        import json
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                results = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return [tuple(result) for result in results]
+
+    def put(self, key, results):
+        """Store the results and evict the least recently used entries."""
+        import json
+        import tempfile
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             suffix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump([list(result) for result in results], f)
+            getattr(os, 'replace', os.rename)(temp_path, self._path(key))
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        import random
+        # Other processes write to the same directory, so the writes of this
+        # one can't be counted
+        if random.random() * self.evict_interval < 1:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        low_water = self.max_entries - self.max_entries // 10
+        for _, path in entries[:len(entries) - low_water]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _Statistics(object):
+
+    """Time spent in each phase of checking a file and how much it handled."""
+
+    COUNTERS = ('traverse_time', 'parse_time', 'call_time', 'literals',
+                'parsed', 'calls', 'cached_calls')
+
     def __init__(self):
-        super(TextVisitor, self).__init__()
-        self.nodes = []
-        self.calls = {}
-
-    def _add_node(self, node):
-        if not hasattr(node, 'is_docstring'):
-            node.is_docstring = False
-        self.nodes += [node]
-
-    def is_base_string(self, node):
-        typ = (ast.Str,)
-        if sys.version_info[0] > 2:
-            typ += (ast.Bytes,)
-        return isinstance(node, typ)
-
-    def visit_Str(self, node):
-        # Constant with Python 3.8 uses the value-property
-        node.value = node.s
-        self._add_node(node)
-
-    def visit_Bytes(self, node):
-        # Constant with Python 3.8 uses the value-property
-        node.value = node.s
-        self._add_node(node)
-
-    def visit_Constant(self, node):
-        if type(node.value) in (str, bytes):
-            self._add_node(node)
-
-    def _visit_definition(self, node):
-        # Manually traverse class or function definition
-        # * Handle decorators normally
-        # * Use special check for body content
-        # * Don't handle the rest (e.g. bases)
-        for decorator in node.decorator_list:
-            self.visit(decorator)
-        self._visit_body(node)
-
-    def _visit_body(self, node):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def as_dict(self):
+        return dict((counter, getattr(self, counter))
+                    for counter in self.COUNTERS)
+
+
+def _record_statistics(path, filename, statistics):
+    """Append the statistics of one file to the records of the report."""
+    import json
+    record = statistics.as_dict()
+    record['filename'] = filename
+    # A single short write, so that the records of multiple processes are
+    # not interleaved
+    with open(path + '.part', 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def write_statistics_report(path):
+    """Aggregate the records of all processes into a JSON report."""
+    import json
+    totals = dict.fromkeys(_Statistics.COUNTERS, 0)
+    files = []
+    try:
+        with open(path + '.part') as f:
+            for line in f:
+                record = json.loads(line)
+                for counter in totals:
+                    totals[counter] += record[counter]
+                files.append(record)
+    except (IOError, OSError):
+        pass
+    # The fraction of format calls whose errors were cached, to tune the size
+    # of that cache
+    hit_rate = (float(totals['cached_calls']) / totals['calls']
+                if totals['calls'] else 0.0)
+    with open(path, 'w') as f:
+        json.dump({'files': len(files), 'totals': totals, 'per_file': files,
+                   'call_cache_hit_rate': hit_rate},
+                  f, indent=2, sort_keys=True)
+    try:
+        os.remove(path + '.part')
+    except OSError:
+        pass
+
+
+class _Baseline(object):
+
+    """
+    Known errors which are not reported again.
+
+    Each error is identified by the path of the file relative to the
+    baseline, its code and a hash of its stripped source line, so that it is
+    still recognized if the line moved. Identical lines with the same code are
+    counted and only that many errors are dropped. The entries are indexed by
+    path and then by code and hash, so that files without known errors are
+    not even hashed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, files=None):
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.files = files if files is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        import json
+        with open(path, 'r') as f:
+            content = json.load(f)
+        if content.get('version') != cls.VERSION:
+            raise ValueError('Unsupported baseline version in {0}'.format(
+                path))
+        files = {}
+        for filename, entries in content['files'].items():
+            files[filename] = dict(
+                (tuple(entry.split(' ', 1)), count)
+                for entry, count in entries.items())
+        return cls(path, files)
+
+    def save(self, path):
+        import json
+        files = {}
+        for filename, entries in self.files.items():
+            files[filename] = dict(('{0} {1}'.format(*entry), count)
+                                   for entry, count in entries.items())
+        with open(path, 'w') as f:
+            json.dump({'version': self.VERSION, 'files': files}, f, indent=1,
+                      sort_keys=True)
+
+    def _relative(self, filename):
+        path = os.path.relpath(os.path.abspath(filename), self.root)
+        return path.replace(os.sep, '/')
+
+    @staticmethod
+    def _entry(msg, line, lines):
+        """Return the code of the error and the hash of its line."""
+        import hashlib
+        text = lines[line - 1].strip() if 0 < line <= len(lines) else ''
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8', 'backslashreplace')
+        digest = hashlib.sha1(text)
+        return msg.split(' ', 1)[0], digest.hexdigest()[:16]
+
+    def add(self, filename, lines, errors):
+        """Add the errors, with a message and their line first, of a file."""
+        entries = self.files.setdefault(self._relative(filename), {})
+        for error in errors:
+            entry = self._entry(error[2], error[0], lines)
+            entries[entry] = entries.get(entry, 0) + 1
+
+    def filter(self, filename, lines, errors):
+        """Yield the errors which are not in the baseline."""
+        entries = self.files.get(self._relative(filename))
+        if not entries:
+            for error in errors:
+                yield error
+            return
+        if lines is None:
+            lines = _read_source(filename).splitlines(True)
+        remaining = dict(entries)
+        for error in errors:
+            entry = self._entry(error[2], error[0], lines)
+            if remaining.get(entry):
+                remaining[entry] -= 1
+            else:
+                yield error
+
+
+# The version specific parts are selected once when the module is imported
+_CONSTANT = getattr(ast, 'Constant', ())
+if sys.version_info >= (3, 8):
+    # Only Constant is used for strings
+    _STRING_NODES = frozenset()
+
+    def _get_text(node):
+        """Return the value of a str or bytes node."""
+        return node.value
+
+    def _is_base_string(node):
+        """Return whether the node is a str or bytes instance."""
+        return (type(node) is _CONSTANT and
+                isinstance(node.value, (str, bytes)))
+else:
+    _STRING_NODES = frozenset([ast.Str, getattr(ast, 'Bytes', ast.Str)])
+
+    def _get_text(node):
+        """Return the value of a str or bytes node."""
+        if isinstance(node, _CONSTANT):
+            return node.value
+        return node.s
+
+    def _is_base_string(node):
+        """Return whether the node is a str or bytes instance."""
+        return type(node) in _STRING_NODES
+
+if sys.version_info[0] > 2:
+    def _decode_bytes(text, is_format, encoding):
         """
-        Traverse the body of the node manually.
+        Return the part of the bytes which may contain fields as text.
+
+        Text outside of the first and last brace cannot change the fields, so
+        only the part in between is decoded, unless a brace byte may be part
+        of a multibyte character in that encoding. It returns None if the
+        bytes cannot contain any fields.
+        """
+        start = text.find(b'{')
+        if start < 0 and not is_format:
+            # Cannot contain any fields so don't decode it
+            return None
+        if not _is_ascii_safe(encoding):
+            return text.decode(encoding, 'replace')
+        closing = text.find(b'}')
+        if start < 0 or 0 <= closing < start:
+            start = closing
+        if start < 0:
+            return ''
+        end = max(text.rfind(b'{'), text.rfind(b'}')) + 1
+        return text[start:end].decode(encoding, 'replace')
+else:
+    def _decode_bytes(text, is_format, encoding):
+        """Return the text of a str or bytes value or None to skip it."""
+        return text
+
+if sys.version_info >= (3, 5):
+    def _get_star_args(call, num_args, keywords):
+        """Return the arguments without the starargs and kwargs."""
+        # With Python version 3.5 the location and number of
+        # kwargs/starargs has been relaxed
+        has_kwargs = None in keywords
+        has_starargs = sum(1 for arg in call.args
+                           if type(arg) is ast.Starred)
+        if has_kwargs:
+            keywords = keywords - frozenset([None])
+        if has_starargs:
+            num_args -= has_starargs
+        return num_args, keywords, has_starargs, has_kwargs
+else:
+    def _get_star_args(call, num_args, keywords):
+        """Return the arguments without the starargs and kwargs."""
+        return num_args, keywords, bool(call.starargs), bool(call.kwargs)
+
+if sys.version_info[:3] == (3, 4, 2):
+    def _get_call_position(call):
+        """Return the position at which errors of the call are reported."""
+        # Due to https://bugs.python.org/issue21295 we cannot use the
+        # Call object
+        return call.func.value.lineno, call.func.value.col_offset
+else:
+    def _get_call_position(call):
+        """Return the position at which errors of the call are reported."""
+        return call.lineno, call.col_offset
+
+# Codecs in which the bytes of braces are never part of another character
+_ASCII_SAFE_ENCODINGS = ('utf-8', 'ascii', 'iso8859', 'cp125', 'koi8', 'mac-',
+                         'euc')
+# The expressions are only compiled, and then cached by re, when first used
+_CODING_PATTERN = r'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)'
+_ascii_safe = {}
+
+
+def _is_ascii_safe(encoding):
+    """Return whether braces can be searched in the encoded bytes."""
+    if encoding not in _ascii_safe:
+        _ascii_safe[encoding] = codecs.lookup(encoding).name.startswith(
+            _ASCII_SAFE_ENCODINGS)
+    return _ascii_safe[encoding]
+
+
+def _get_declared_encoding(lines):
+    """Return the encoding declared in the first two lines of the file."""
+    for line in lines[:2]:
+        match = re.match(_CODING_PATTERN, line)
+        if match:
+            try:
+                return codecs.lookup(match.group(1)).name
+            except LookupError:
+                break
+        if line.strip() and not line.lstrip().startswith('#'):
+            # The second line is only used if the first is a comment
+            break
+    return 'utf-8'
+
+
+# Nodes which can neither be nor contain any strings. Since Python 3.8 the
+# parser creates no Num, NameConstant and Ellipsis, which are deprecated.
+_LEAF_NAMES = ('Name', 'Pass', 'Break', 'Continue', 'Import', 'ImportFrom',
+               'Global', 'Nonlocal', 'alias')
+if sys.version_info < (3, 8):
+    _LEAF_NAMES += ('Num', 'NameConstant', 'Ellipsis')
+_LEAF_NODES = frozenset(
+    [getattr(ast, name) for name in _LEAF_NAMES if hasattr(ast, name)] +
+    [node for base in (ast.expr_context, ast.boolop, ast.operator,
+                       ast.unaryop, ast.cmpop)
+     for node in base.__subclasses__()])
+
+
+# Elements of lists in the tree which are skipped, like the names of Global
+_NOT_VISITED = _LEAF_NODES | frozenset([type(None), str])
+_LIST_ITERATOR = type(iter([]))
+_LIST_END = object()
+
+
+def _get_new_range(hunk):
+    """Return the first and last line of the hunk in the new file."""
+    new_start, new_count = hunk[2:]
+    if new_count:
+        return new_start, new_start + new_count - 1
+    # Lines were only removed, so anything around them may be affected
+    return new_start, new_start + 1
+
+
+def _shift_line(line, hunks):
+    """Return the new line of an unchanged line or None if it changed."""
+    shift = 0
+    for old_start, old_count, new_start, new_count in hunks:
+        if old_count and old_start <= line < old_start + old_count:
+            return None
+        # Without any old lines it inserts after the old start
+        if line >= old_start + (old_count or 1):
+            shift += new_count - old_count
+    return line + shift
+
+
+def _overlaps(record, ranges):
+    """Return whether any of the lines of the record are in the ranges."""
+    return any(record.lineno <= end and start <= record.end_lineno
+               for start, end in ranges)
+
+
+_HUNK_PATTERN = r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@'
+# The range of the lines of files which are new to the repository
+_WHOLE_FILE = [(1, sys.maxsize)]
+
+
+class _Changes(object):
+
+    """
+    Lines which changed in the local repository compared to a git ref.
+
+    The changes of the working tree against the ref are read once from ``git
+    diff`` without any context lines. Files which are not tracked by git yet
+    are considered changed completely.
+
+    The headers of the patch quote some names and append a tab to others, so
+    the names are read separately and assigned to the files of the patch in
+    the same order.
+    """
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.files = {}
+        root = os.path.realpath(
+            self._git('rev-parse', '--show-toplevel').strip())
+        names = iter(self._git('diff', '--name-only', '-z', ref,
+                               '--').split('\0'))
+        filename = None
+        is_header = False
+        for line in self._git('diff', '-U0', '--no-color', '--no-ext-diff',
+                              ref, '--').split('\n'):
+            if line.startswith('diff --git '):
+                filename = os.path.join(root, next(names))
+                self.files[filename] = []
+                is_header = True
+            elif is_header and line == '+++ /dev/null':
+                # The file was deleted
+                del self.files[filename]
+                filename = None
+            elif filename is not None:
+                match = re.match(_HUNK_PATTERN, line)
+                if match:
+                    is_header = False
+                    hunk = tuple(int(number) if number is not None else 1
+                                 for number in match.groups())
+                    self.files[filename].append(_get_new_range(hunk))
+        for line in self._git('ls-files', '--others', '--exclude-standard',
+                              '-z').split('\0'):
+            if line:
+                self.files[os.path.join(root, line)] = _WHOLE_FILE
+
+    def _git(self, *args):
+        import subprocess
+        try:
+            process = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError as e:
+            raise ValueError('Cannot run git: {0}'.format(e))
+        stdout, stderr = process.communicate()
+        if process.returncode:
+            raise ValueError('Cannot get the changes against {0}: {1}'.format(
+                self.ref, stderr.decode('utf-8', 'replace').strip()))
+        return stdout.decode('utf-8', 'surrogateescape'
+                             if sys.version_info[0] > 2 else 'replace')
+
+    def get(self, filename):
+        """Return the changed ranges of lines of the file."""
+        return self.files.get(os.path.realpath(filename), [])
+
+
+def _get_end_lineno(node):
+    """Return the last line of the node, also before Python 3.8."""
+    end_lineno = getattr(node, 'end_lineno', None)
+    if end_lineno is None:
+        # Older versions only know the first line of each node
+        end_lineno = max(getattr(child, 'lineno', node.lineno)
+                         for child in ast.walk(node))
+    return end_lineno
+
+
+class _FormatCall(object):
+
+    """The position and the shape of the arguments of a call to format."""
+
+    __slots__ = ('lineno', 'col_offset', 'end_lineno', 'num_args',
+                 'keywords', 'has_starargs', 'has_kwargs')
+
+    def __init__(self, node, str_args):
+        self.lineno, self.col_offset = _get_call_position(node)
+        self.end_lineno = _get_end_lineno(node)
+        (self.num_args, self.keywords, self.has_starargs,
+         self.has_kwargs) = _get_call_args(node, str_args)
+
+
+class _Literal(object):
+
+    """A str or bytes instance with the call to format it is used in."""
+
+    __slots__ = ('lineno', 'col_offset', 'end_lineno', 'value',
+                 'is_docstring', 'call')
+
+    def __init__(self, node, is_docstring, call):
+        self.lineno = node.lineno
+        self.col_offset = node.col_offset
+        self.end_lineno = _get_end_lineno(node)
+        self.value = _get_text(node)
+        self.is_docstring = is_docstring
+        self.call = call
+
+    # Only a constant defined somewhere else is reported at the call
+    is_constant = False
+
+
+class _ConstantLiteral(_Literal):
+
+    """The value of a named constant which is formatted in a call."""
+
+    __slots__ = ()
+
+    is_constant = True
+
+    def __init__(self, value, call):
+        self.lineno = call.lineno
+        self.col_offset = call.col_offset
+        self.end_lineno = call.end_lineno
+        self.value = value
+        self.is_docstring = False
+        self.call = call
+
+
+def _split_field_name(field):
+    """
+    Return the first name of the field and its index if it is a number.
+
+    The name ends at the first dot or at the first opening bracket if the field
+    ends with a closing bracket. Except for a final newline everything after
+    the first name must be on one line. Negative numbers are names. The field
+    is scanned only once, so it takes linear time on any field.
+    """
+    end = len(field)
+    if field.endswith(_NEWLINE):
+        end -= 1
+    start = field.rfind(_NEWLINE, 0, end) + 1
+    split = field.find(_DOT, start, end)
+    if split < 0:
+        split = end
+    if end - start >= 2 and field[end - 1] == _CLOSE_BRACKET:
+        bracket = field.find(_OPEN_BRACKET, start, split)
+        if bracket >= 0:
+            split = bracket
+    name = field[:split]
+    try:
+        number = int(name)
+    except ValueError:
+        return name, None
+    # negative numbers are considered keywords
+    return (name, None) if number < 0 else (name, number)
+
+
+_NO_KEYWORDS = frozenset()
+
+
+def _get_call_args(call, str_args):
+    """
+    Return the arguments of the call to format.
+
+    It returns the number of positional arguments, the keywords and whether
+    there are variable positional and keyword arguments.
+    """
+    if call.keywords:
+        keywords = frozenset(keyword.arg for keyword in call.keywords)
+    else:
+        # Share the empty set as most calls have no keywords
+        keywords = _NO_KEYWORDS
+    num_args = len(call.args)
+    if str_args:
+        num_args -= 1
+    return _get_star_args(call, num_args, keywords)
+
+
+class TextVisitor(object):
+
+    """
+    Scanner for bytes and str instances.
+
+    It tries to detect docstrings as string of the first expression of each
+    module, class or function. The tree is traversed iteratively and only
+    nodes which may contain strings are visited. Instead of the nodes it
+    records compact ``_Literal`` instances in ``literals``, so that the tree
+    is neither modified nor kept alive. Alternatively ``iter_literals`` yields
+    each of them as soon as it is reached without recording them.
+    """
+
+    def __init__(self, resolve=None, docstrings=True, others=True):
+        self.literals = []
+        # The nodes are removed as soon as they are visited
+        self._calls = {}
+        self._docstrings = set()
+        # Returns the value of the constant a Name or Attribute refers to
+        self._resolve = resolve
+        # Whether docstrings and other strings which aren't formatted are
+        # recorded at all
+        self._record_docstrings = docstrings
+        self._record_others = others
+
+    is_base_string = staticmethod(_is_base_string)
+
+    def visit(self, node):
+        """Collect all strings and format calls in the node."""
+        self.literals.extend(self.iter_literals(node))
+
+    def iter_literals(self, node):
+        """Yield the strings in the node with the format call using them."""
+        string_types = (str, bytes)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            typ = type(node)
+            if typ is _LIST_ITERATOR:
+                # Lists are consumed one element at a time, so that the stack
+                # doesn't grow with the length of the body or of a literal
+                child = next(node, _LIST_END)
+                if child is _LIST_END:
+                    continue
+                stack.append(node)
+                node = child
+                typ = type(node)
+                if typ in _NOT_VISITED:
+                    continue
+            if typ is _CONSTANT or typ in _STRING_NODES:
+                if (typ is not _CONSTANT or
+                        isinstance(node.value, string_types)):
+                    literal = self._get_literal(node)
+                    if literal is not None:
+                        yield literal
+            elif typ is ast.Expr:
+                # Skip Expr unless they are calls as they won't be formatted
+                # anyway, docstrings are handled separately
+                if isinstance(node.value, ast.Call):
+                    stack.append(node.value)
+            elif typ is ast.Module:
+                self._push_body(stack, node)
+            elif typ is ast.ClassDef or typ is ast.FunctionDef:
+                # Only handle decorators and the body
+                # Skipped nodes: ('name', 'args', 'returns', 'bases', …)
+                self._push_body(stack, node)
+                stack.extend(reversed(node.decorator_list))
+            else:
+                if typ is ast.Call:
+                    literal = self._add_call(node)
+                    if literal is not None:
+                        yield literal
+                self._push_children(stack, node)
+
+    def _get_literal(self, node):
+        is_docstring = node in self._docstrings
+        if is_docstring:
+            self._docstrings.discard(node)
+        call = self._calls.pop(node, None)
+        if call is None and not (self._record_docstrings if is_docstring
+                                 else self._record_others):
+            return None
+        return _Literal(node, is_docstring, call)
+
+    def _push_body(self, stack, node):
+        """
+        Push the body of the node onto the stack.
 
         If the first node is an expression which contains a string or bytes it
         marks that as a docstring.
         """
+        stack.append(iter(node.body))
         if (node.body and isinstance(node.body[0], ast.Expr) and
                 self.is_base_string(node.body[0].value)):
-            node.body[0].value.is_docstring = True
-            self.visit(node.body[0].value)
-
-        for sub_node in node.body:
-            self.visit(sub_node)
-
-    def visit_Expr(self, node):
-        # Skip Expr unless they are calls as they won't be formatted anyway
-        # docstrings are handled separately
-        if isinstance(node.value, ast.Call):
-            self.visit_Call(node.value)
+            self._docstrings.add(node.body[0].value)
+            stack.append(node.body[0].value)
 
-    def visit_Module(self, node):
-        self._visit_body(node)
+    def _push_children(self, stack, node):
+        # The last field is pushed first so that the first one is popped first
+        for field in reversed(node._fields):
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if value:
+                    stack.append(iter(value))
+            elif (isinstance(value, ast.AST) and
+                    type(value) not in _LEAF_NODES):
+                stack.append(value)
 
-    def visit_ClassDef(self, node):
-        # Skipped nodes: ('name', 'bases', 'keywords', 'starargs', 'kwargs')
-        self._visit_definition(node)
-
-    def visit_FunctionDef(self, node):
-        # Skipped nodes: ('name', 'args', 'returns')
-        self._visit_definition(node)
+    def _add_call(self, node):
+        """
+        Record the call to format of a string.
 
-    def visit_Call(self, node):
+        If the format string is a named constant it returns its record right
+        away, as there is no string in the call which would be visited.
+        """
         if (isinstance(node.func, ast.Attribute) and
                 node.func.attr == 'format'):
             if self.is_base_string(node.func.value):
-                self.calls[node.func.value] = (node, False)
+                self._calls[node.func.value] = _FormatCall(node, False)
             elif (isinstance(node.func.value, ast.Name) and
-                    node.func.value.id == 'str' and node.args and
-                    self.is_base_string(node.args[0])):
-                self.calls[node.args[0]] = (node, True)
-        super(TextVisitor, self).generic_visit(node)
+                    node.func.value.id == 'str' and node.args):
+                if self.is_base_string(node.args[0]):
+                    self._calls[node.args[0]] = _FormatCall(node, True)
+                elif self._resolve is not None:
+                    return self._get_constant(node, node.args[0], True)
+            elif self._resolve is not None:
+                return self._get_constant(node, node.func.value, False)
+        return None
+
+    def _get_constant(self, node, receiver, str_args):
+        value = self._resolve(receiver)
+        if value is None:
+            return None
+        return _ConstantLiteral(value, _FormatCall(node, str_args))
+
+
+def _get_dotted_name(node):
+    """Return the dotted name of a chain of attributes or None."""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+def _get_bound_names(node):
+    """Return the names bound by the node itself."""
+    if isinstance(node, ast.Name):
+        return () if isinstance(node.ctx, ast.Load) else (node.id,)
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef, _ASYNC_DEF)):
+        return (node.name,)
+    if isinstance(node, ast.alias):
+        # "import a.b" binds "a"
+        return ((node.asname or node.name).split('.')[0],)
+    if isinstance(node, _ARG):
+        return (node.arg,)
+    # The name of an exception handler and of match patterns
+    name = getattr(node, 'name', None)
+    if isinstance(name, str):
+        return (name,)
+    return ()
+
+
+_ASYNC_DEF = getattr(ast, 'AsyncFunctionDef', ())
+_ARG = getattr(ast, 'arg', ())
+
+
+def _count_bindings(tree):
+    """
+    Return how often each name is bound anywhere in the tree.
+
+    Names bound directly in the body of a class are prefixed with the name of
+    the class, as are attributes assigned using the class. All other names are
+    counted without a prefix, so that a constant shadowed by a local variable
+    is bound more than once.
+    """
+    counts = {}
+    stack = [(tree, '')]
+    while stack:
+        node, prefix = stack.pop()
+        if (isinstance(node, ast.Attribute) and
+                not isinstance(node.ctx, ast.Load)):
+            name = _get_dotted_name(node)
+            if name is not None:
+                counts[name] = counts.get(name, 0) + 1
+        for name in _get_bound_names(node):
+            counts[prefix + name] = counts.get(prefix + name, 0) + 1
+        if isinstance(node, ast.ClassDef):
+            body_prefix = prefix + node.name + '.'
+            stack.extend((child, body_prefix) for child in node.body)
+            stack.extend((child, prefix)
+                         for field in ('bases', 'keywords', 'decorator_list')
+                         for child in getattr(node, field, ()))
+        elif isinstance(node, (ast.FunctionDef, ast.Lambda, _ASYNC_DEF)):
+            # Decorators and defaults are evaluated in the enclosing scope
+            # but counting them as local only makes it more conservative
+            stack.extend((child, '') for child in ast.iter_child_nodes(node))
+        else:
+            stack.extend((child, prefix)
+                         for child in ast.iter_child_nodes(node))
+    return counts
+
+
+def _collect_constants(tree):
+    """
+    Return the str constants of the module and its classes.
+
+    A constant is a name assigned only once in the whole module, directly to
+    a str. The names of class attributes are prefixed with the name of the
+    class.
+    """
+    counts = _count_bindings(tree)
+    constants = {}
+    stack = [(statement, '') for statement in tree.body]
+    while stack:
+        node, prefix = stack.pop()
+        if isinstance(node, ast.ClassDef):
+            if counts.get(prefix + node.name) == 1:
+                stack.extend((statement, prefix + node.name + '.')
+                             for statement in node.body)
+            continue
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+        elif isinstance(node, getattr(ast, 'AnnAssign', ())) and node.value:
+            target = node.target
+        else:
+            continue
+        if (isinstance(target, ast.Name) and
+                _is_base_string(node.value) and
+                counts.get(prefix + target.id) == 1):
+            value = _get_text(node.value)
+            # On Python 2 a str is bytes
+            if sys.version_info[0] < 3 or not isinstance(value, bytes):
+                constants[prefix + target.id] = value
+    return constants
+
+
+class _ConstantIndex(object):
+
+    """
+    Index of the str constants of the imported modules.
+
+    The constants of each module are only collected once per run, unless the
+    modification time or the size of the module changed. If there is a result
+    cache, they are also stored in it by the hash of the module. The path of a
+    module imported from a directory is only searched once per run.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._modules = {}
+        self._paths = {}
+
+    def find_module(self, name, level, filename):
+        """Return the path of the module imported in the file or None."""
+        directory = os.path.dirname(os.path.abspath(filename or '.'))
+        key = name, level, directory
+        if key not in self._paths:
+            self._paths[key] = self._find_module(name, level, directory)
+        return self._paths[key]
+
+    def _find_module(self, name, level, directory):
+        parts = name.split('.') if name else []
+        if level:
+            for _ in range(level - 1):
+                directory = os.path.dirname(directory)
+            roots = [directory]
+        else:
+            # The directory which contains the package of the file
+            while os.path.isfile(os.path.join(directory, '__init__.py')):
+                directory = os.path.dirname(directory)
+            roots = [directory, os.getcwd()]
+        if not parts and not level:
+            return None
+        for root in roots:
+            path = os.path.join(root, *parts)
+            candidates = [os.path.join(path, '__init__.py')]
+            if parts:
+                candidates.insert(0, path + '.py')
+            for candidate in candidates:
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def get(self, path):
+        """Return the hash and the constants of the module."""
+        try:
+            stat = os.stat(path)
+            signature = stat.st_mtime, stat.st_size
+        except OSError:
+            signature = None
+        result = self._modules.get(path)
+        if result is None or result[0] != signature:
+            result = self._modules[path] = (signature,) + self._load(path)
+        return result[1:]
+
+    def _load(self, path):
+        import hashlib
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+        except (IOError, OSError):
+            return '', {}
+        digest = hashlib.sha256(source).hexdigest()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(source, ['constants'])
+            constants = self.cache.get(key)
+            if constants is not None:
+                return digest, dict(constants)
+        try:
+            constants = _collect_constants(ast.parse(source))
+        except (SyntaxError, ValueError, TypeError):
+            constants = {}
+        if key is not None:
+            self.cache.put(key, sorted(constants.items()))
+        return digest, constants
+
+
+class _ConstantResolver(object):
+
+    """Resolver of the constants a file refers to by name."""
+
+    def __init__(self, tree, filename, index):
+        self.filename = filename
+        self.index = index
+        self.counts = _count_bindings(tree)
+        self.constants = _collect_constants(tree)
+        # The module and name each name is imported from
+        self.imports = {}
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    if alias.asname:
+                        self.imports[alias.asname] = (alias.name, 0, None)
+                    else:
+                        name = alias.name.split('.')[0]
+                        self.imports[name] = (name, 0, None)
+            elif isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    self.imports[alias.asname or alias.name] = (
+                        node.module or '', node.level or 0, alias.name)
+
+    def _get_module(self, name, level):
+        path = self.index.find_module(name, level, self.filename)
+        if path is None:
+            return None
+        return self.index.get(path)[1]
+
+    def _lookup(self, module, level, dotted):
+        """Return the constant in the module or any of its submodules."""
+        while True:
+            constants = self._get_module(module, level)
+            if constants is not None and dotted in constants:
+                return constants[dotted]
+            if '.' not in dotted:
+                return None
+            submodule, dotted = dotted.split('.', 1)
+            module = module + '.' + submodule if module else submodule
+
+    def resolve(self, node):
+        """Return the value of the constant the node refers to or None."""
+        dotted = _get_dotted_name(node)
+        if dotted is None:
+            return None
+        if dotted in self.constants:
+            return self.constants[dotted]
+        head = dotted.split('.', 1)[0]
+        if head not in self.imports or self.counts.get(head) != 1:
+            return None
+        module, level, name = self.imports[head]
+        if name is not None:
+            dotted = name + dotted[len(head):]
+        elif '.' in dotted:
+            # The first part is the imported module itself
+            dotted = dotted.split('.', 1)[1]
+        else:
+            return None
+        return self._lookup(module, level, dotted)
+
+    def fingerprint(self):
+        """Return the hashes of all modules the constants may come from."""
+        hashes = []
+        modules = set()
+        for module, level, name in self.imports.values():
+            modules.add((module, level))
+            if name is not None:
+                modules.add((module + '.' + name if module else name, level))
+        for module_name, level in sorted(modules):
+            if module_name or level:
+                path = self.index.find_module(module_name, level,
+                                              self.filename)
+                digest = self.index.get(path)[0] if path else ''
+                hashes.append('{0}:{1}:{2}'.format(level, module_name, digest))
+        return '\n'.join(hashes)
+
+
+# The codes of the analysis of the arguments of a format call
+_ANALYSIS_CODES = frozenset([201, 202, 203, 204, 205, 301, 302])
+
+
+def _split_shards(tree, shard_lines):
+    """Return the start and end index of each shard of the top-level nodes."""
+    body = tree.body
+    bounds = []
+    start = 0
+    for index in range(1, len(body)):
+        if body[index].lineno - body[start].lineno >= shard_lines:
+            bounds.append((start, index))
+            start = index
+    bounds.append((start, len(body)))
+    return bounds
+
+
+# The checker of the module whose shards are checked by the forked processes
+_sharded_checker = None
+
+
+def _check_shard(bounds):
+    """Return the errors of the top-level nodes of the sharded module."""
+    checker = _sharded_checker
+    start, end = bounds
+    body = checker.tree.body[start:end]
+    if start:
+        # Only the first node of the module can be a docstring
+        body = [ast.Pass()] + body
+    shard = type(checker)(ast.Module(body=body), checker.filename,
+                          checker.lines)
+    shard._shard_lines = 0
+    return [error[:3] for error in shard._run()]
 
 
 class StringFormatChecker(object):
 
     _FORMATTER = Formatter()
-    FIELD_REGEX = re.compile(r'^((?:\s|.)*?)(\..*|\[.*\])?$')
-
     version = __version__
     name = 'flake8-string-format'
 
@@ -127,130 +1171,1242 @@ class StringFormatChecker(object):
         302: 'format call provides unused keyword ({kw})',
     }
 
-    def __init__(self, tree, filename):
+    _NO_FIELDS = (frozenset(), False, False)
+
+    _mode = 'ast'
+    _enabled_codes = frozenset(ERRORS)
+    _result_cache = None
+    _stats_path = None
+    _constant_index = None
+    _baseline = None
+    _changes = None
+    _shard_lines = 0
+    _shard_jobs = None
+    # The parsed fields are shared by all files checked in the same process
+    _parse_cache = _LRUCache(4096)
+    # The numbers and names of the fields used in format calls
+    _field_kinds_cache = _LRUCache(4096)
+    # The errors of format calls by their template and arguments
+    _call_cache = _LRUCache(4096)
+
+    def __init__(self, tree, filename, lines=None):
         self.tree = tree
+        self.filename = filename
+        self.lines = lines
+        # Only determined once there are bytes which may contain fields
+        self._encoding = None
+        self._resolver = None
+        # Stages whose errors are all disabled are skipped
+        enabled = self._enabled_codes
+        self._analyse_calls = not enabled.isdisjoint(_ANALYSIS_CODES)
+        self._check_calls = self._analyse_calls or 101 in enabled
+
+    @classmethod
+    def add_options(cls, parser):
+        _register_opt(
+            parser, '--fmt-mode', default='ast', choices=('ast', 'tokens'),
+            parse_from_config=True,
+            help='Whether the strings are found using the abstract syntax '
+                 'tree or only using the tokens (default: ast)')
+        _register_opt(
+            parser, '--fmt-cache-dir', default=None, parse_from_config=True,
+            help='Directory in which the results of unchanged files are '
+                 'cached between runs (default: no caching)')
+        _register_opt(
+            parser, '--fmt-cache-size', default=10000, type=int,
+            parse_from_config=True,
+            help='Maximum number of files kept in the result cache '
+                 '(default: 10000)')
+        _register_opt(
+            parser, '--fmt-parse-cache-size', default=4096, type=int,
+            parse_from_config=True,
+            help='Maximum number of parsed format strings kept in memory, '
+                 '0 disables it (default: 4096)')
+        _register_opt(
+            parser, '--fmt-call-cache-size', default=4096, type=int,
+            parse_from_config=True,
+            help='Maximum number of format calls whose errors are kept in '
+                 'memory by their template and arguments, 0 disables it '
+                 '(default: 4096)')
+        _register_opt(
+            parser, '--fmt-constants', default=False, action='store_true',
+            parse_from_config=True,
+            help='Also check calls to format on str constants defined in the '
+                 'same module, in a class or in an imported module')
+        _register_opt(
+            parser, '--fmt-diff-base', default=None, parse_from_config=True,
+            help='Only report errors in lines which changed compared to this '
+                 'git ref of the local repository (default: report all '
+                 'errors)')
+        _register_opt(
+            parser, '--fmt-shard-lines', default=0, type=int,
+            parse_from_config=True,
+            help='Split modules with more lines into shards of about this '
+                 'many lines which are checked in parallel, 0 disables it '
+                 '(default: 0)')
+        _register_opt(
+            parser, '--fmt-shard-jobs', default=None, type=int,
+            parse_from_config=True,
+            help='Number of processes checking the shards (default: number '
+                 'of CPUs)')
+        _register_opt(
+            parser, '--fmt-baseline', default=None, parse_from_config=True,
+            help='File with known errors which are not reported (default: '
+                 'report all errors)')
+        _register_opt(
+            parser, '--fmt-stats', default=os.environ.get(STATISTICS_ENV),
+            parse_from_config=True,
+            help='Write the time spent in each phase of the check into this '
+                 'JSON file (default: ${0})'.format(STATISTICS_ENV))
+
+    @classmethod
+    def parse_options(cls, options):
+        cls._mode = options.fmt_mode
+        cls._enabled_codes = _get_enabled_codes(options)
+        if options.fmt_cache_dir:
+            cls._result_cache = _ResultCache(
+                os.path.abspath(options.fmt_cache_dir),
+                int(options.fmt_cache_size))
+        else:
+            cls._result_cache = None
+        cls._parse_cache = _LRUCache(int(options.fmt_parse_cache_size))
+        cls._field_kinds_cache = _LRUCache(int(options.fmt_parse_cache_size))
+        cls._call_cache = _LRUCache(int(options.fmt_call_cache_size))
+        if options.fmt_constants:
+            cls._constant_index = _ConstantIndex(cls._result_cache)
+        else:
+            cls._constant_index = None
+        if options.fmt_baseline:
+            cls._baseline = _Baseline.load(options.fmt_baseline)
+        else:
+            cls._baseline = None
+        if options.fmt_diff_base:
+            cls._changes = _Changes(options.fmt_diff_base)
+        else:
+            cls._changes = None
+        cls._shard_lines = int(options.fmt_shard_lines or 0)
+        cls._shard_jobs = options.fmt_shard_jobs
+        cls._enable_statistics(options.fmt_stats)
+
+    @classmethod
+    def _enable_statistics(cls, path):
+        """Record statistics and write the report when the run ends."""
+        cls._stats_path = os.path.abspath(path) if path else None
+        if not cls._stats_path:
+            return
+        import multiprocessing
+        # Workers of Flake8 only record the statistics
+        if multiprocessing.current_process().name == 'MainProcess':
+            open(cls._stats_path + '.part', 'w').close()
+            atexit.register(write_statistics_report, cls._stats_path)
 
-    def _generate_unindexed(self, node):
-        return self._generate_error(
-            node, 102 if node.is_docstring else 103)
+    def _generate_unindexed(self, literal):
+        return self._generate_error(literal,
+                                    102 if literal.is_docstring else 103)
 
-    def _generate_error(self, node, code, **params):
-        if sys.version_info[:3] == (3, 4, 2) and isinstance(node, ast.Call):
-            # Due to https://bugs.python.org/issue21295 we cannot use the
-            # Call object
-            node = node.func.value
+    def _generate_error(self, record, code, **params):
+        msg = self._get_message(code, params)
+        return record.lineno, record.col_offset, msg, type(self)
+
+    def _get_message(self, code, params):
         msg = 'FMT{0} {1}'.format(code, self.ERRORS[code])
-        msg = msg.format(**params)
-        return node.lineno, node.col_offset, msg, type(self)
+        for key, value in params.items():
+            # Names of fields in Python 2 byte strings
+            if isinstance(value, bytes):
+                params[key] = value.decode('utf-8', 'replace')
+        return msg.format(**params)
 
     def get_fields(self, string):
+        """
+        Return the fields and whether there are implicit and explicit indexes.
+
+        The fields are returned as a frozenset, as the results are cached for
+        all strings checked in the same process.
+        """
+        # Only replacement fields start with a brace, a single closing brace
+        # is an error which results in no fields either
+        if _OPEN_BRACE not in string:
+            return self._NO_FIELDS
+        result = self._parse_cache.get(string)
+        if result is None:
+            fields, implicit, explicit = self._scan_fields(string)
+            result = frozenset(fields), implicit, explicit
+            self._parse_cache.put(string, result)
+        return result
+
+    def _scan_fields(self, string):
+        """
+        Return the fields and whether there are implicit and explicit indexes.
+
+        The string is parsed in a single pass. Only the format specs which
+        contain a brace are parsed for nested fields and the nested fields are
+        added without a generator.
+        """
         fields = set()
-        cnt = itertools.count()
+        count = 0
         implicit = False
         explicit = False
         try:
-            for literal, field, spec, conv in self._FORMATTER.parse(string):
-                if field is not None and (conv is None or conv in 'rsa'):
-                    if not field:
-                        field = str(next(cnt))
-                        implicit = True
-                    else:
-                        explicit = True
-                    fields.add(field)
-                    fields.update(parsed_spec[1]
-                                  for parsed_spec in self._FORMATTER.parse(spec)
-                                  if parsed_spec[1] is not None)
-        except ValueError as e:
+            for _, name, spec, conversion in self._FORMATTER.parse(string):
+                if (name is None or
+                        conversion and conversion not in _CONVERSIONS):
+                    continue
+                if name:
+                    explicit = True
+                else:
+                    name = str(count)
+                    count += 1
+                    implicit = True
+                fields.add(name)
+                if _OPEN_BRACE in spec:
+                    for _, nested, _, _ in self._FORMATTER.parse(spec):
+                        if nested is not None:
+                            fields.add(nested)
+        except ValueError:
             return set(), False, False
-        else:
-            return fields, implicit, explicit
+        return fields, implicit, explicit
 
     def run(self):
-        visitor = TextVisitor()
+        # Files without changes are not even traversed
+        if not self._get_changed_ranges():
+            return iter(())
+        errors = self._run_cached()
+        # The checker of the tokens does not know the file
+        if self._baseline is not None and self.filename is not None:
+            errors = self._baseline.filter(self.filename, self.lines, errors)
+        return errors
+
+    def _run_cached(self):
+        cache = self._result_cache
+        # In the token mode this checker has no results, which must not be
+        # cached for the same source in the ast mode
+        if cache is None or self.lines is None or self._mode != 'ast':
+            for error in self._run():
+                yield error
+            return
+
+        source = _EMPTY.join(self.lines)
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8', 'backslashreplace')
+        if self._constant_index is not None:
+            # The results also depend on the constants of imported modules
+            source += b'\0' + self._get_resolver().fingerprint().encode(
+                'utf-8')
+        if self._changes is not None:
+            source += b'\0' + repr(self._get_changed_ranges()).encode('ascii')
+        key = cache.key(source, self._enabled_codes)
+        results = cache.get(key)
+        if results is None:
+            results = [error[:3] for error in self._run()]
+            cache.put(key, results)
+        for line, col, msg in results:
+            yield line, col, msg, type(self)
+
+    def _run(self):
+        if self._mode != 'ast' or not self._enabled_codes:
+            return
+        if self._is_sharded():
+            results = self._run_sharded()
+            if results is not None:
+                for line, col, msg in results:
+                    yield line, col, msg, type(self)
+                return
+
+        changed = self._get_changed_ranges()
+        if changed is _WHOLE_FILE:
+            changed = None
+        if not self._stats_path:
+            # Check each string as soon as it is reached, so that neither the
+            # strings are kept nor the errors are delayed until the end
+            for literal in self._get_visitor().iter_literals(self.tree):
+                if changed is None or self._is_changed(literal, changed):
+                    for error in self._check_literal(literal):
+                        yield error
+            return
+
+        # The phases are only separated to measure them
+        stats = _Statistics()
+        start = default_timer()
+        misses = self._parse_cache.misses
+        visitor = self._get_visitor()
+        visitor.visit(self.tree)
+        assert not visitor._calls
+        stats.traverse_time = default_timer() - start
+        stats.literals = len(visitor.literals)
+        for literal in visitor.literals:
+            if changed is None or self._is_changed(literal, changed):
+                for error in self._check_literal(literal, stats):
+                    yield error
+
+        stats.parsed = self._parse_cache.misses - misses
+        _record_statistics(self._stats_path, self.filename, stats)
+
+    def _is_sharded(self):
+        """Return whether the module is large enough to be split."""
+        if (not self._shard_lines or self.lines is None or
+                len(self.lines) <= self._shard_lines):
+            return False
+        # These need the whole module
+        if (self._stats_path or self._constant_index is not None or
+                self._changes is not None):
+            return False
+        import multiprocessing
+        # Workers of a pool, like the ones of Flake8, cannot start processes
+        return not multiprocessing.current_process().daemon
+
+    def _run_sharded(self):
+        """
+        Return the errors of all shards of the module in their order.
+
+        The processes are forked for each module, so that they share the tree
+        instead of receiving it. Only the bounds of the shards and the errors
+        are sent between the processes. As each shard is checked like the
+        module, the errors are the same as if it is checked in one process.
+        Without fork it returns None to check the module in one process.
+        """
+        global _sharded_checker
+        import multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                return None
+            context = multiprocessing.get_context('fork')
+        elif os.name == 'posix':
+            context = multiprocessing
+        else:
+            return None
+        shards = _split_shards(self.tree, self._shard_lines)
+        if len(shards) < 2:
+            return None
+        _sharded_checker = self
+        # Otherwise the collector of the processes touches and thus copies the
+        # memory of every object of the tree
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        try:
+            pool = context.Pool(min(self._shard_jobs or context.cpu_count(),
+                                    len(shards)))
+        finally:
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
+        try:
+            results = pool.map(_check_shard, shards)
+        finally:
+            pool.terminate()
+            pool.join()
+            _sharded_checker = None
+        return [error for shard in results for error in shard]
+
+    def _get_changed_ranges(self):
+        """Return the changed lines of the file, all of them by default."""
+        # The checker of the tokens does not know the file
+        if self._changes is None or self.filename is None:
+            return _WHOLE_FILE
+        return self._changes.get(self.filename)
+
+    @staticmethod
+    def _is_changed(literal, ranges):
+        """Return whether the string or the call it's used in changed."""
+        return (_overlaps(literal, ranges) or
+                literal.call is not None and _overlaps(literal.call, ranges))
+
+    def _get_resolver(self):
+        if self._resolver is None:
+            self._resolver = _ConstantResolver(self.tree, self.filename,
+                                               self._constant_index)
+        return self._resolver
+
+    def _get_visitor(self):
+        """
+        Return the visitor which also resolves constants if enabled.
+
+        It only records the strings which can cause enabled errors.
+        """
+        resolve = None
+        if self._constant_index is not None and self._analyse_calls:
+            resolve = self._get_resolver().resolve
+        return TextVisitor(resolve, docstrings=102 in self._enabled_codes,
+                           others=103 in self._enabled_codes)
+
+    def _is_checked(self, is_call, is_docstring):
+        """Return whether the string can cause any enabled error."""
+        if is_call:
+            return self._check_calls
+        return (102 if is_docstring else 103) in self._enabled_codes
+
+    def _check_literal(self, literal, stats=None):
+        """Check the string and the format call it's used in."""
+        call = literal.call
+        if call is not None and not self._check_calls:
+            return
+        text = self._get_string(literal.value, call is not None)
+        if text is None:
+            return
+        if stats is not None:
+            start = default_timer()
+        fields, implicit, explicit = self.get_fields(text)
+        if stats is not None:
+            stats.parse_time += default_timer() - start
+        if implicit and not literal.is_constant:
+            if call is not None:
+                assert not literal.is_docstring
+                yield self._generate_error(literal, 101)
+            else:
+                yield self._generate_unindexed(literal)
+
+        if call is not None and self._analyse_calls:
+            if stats is not None:
+                start = default_timer()
+                hits = self._call_cache.hits
+            errors = self._get_call_errors(
+                text, fields, implicit, explicit, call.num_args,
+                call.keywords, call.has_starargs, call.has_kwargs)
+            if stats is not None:
+                stats.call_time += default_timer() - start
+                stats.calls += 1
+                stats.cached_calls += self._call_cache.hits - hits
+            for code, params in errors:
+                yield self._generate_error(call, code, **params)
+
+    def run_incremental(self, previous, hunks):
+        """
+        Check only the strings and format calls in changed lines.
+
+        The previous results are the results of the file before the change.
+        The hunks are tuples of the start and number of lines in the old and
+        new file, like the header of a hunk in a unified diff. The previous
+        results outside of the hunks are reused, shifted to their new line.
+        Docstrings are always checked again, as inserting a statement before
+        a docstring changes how it's treated. So are calls formatting a
+        constant, which may have been changed somewhere else.
+
+        It returns the results sorted by line and column.
+        """
+        visitor = self._get_visitor()
         visitor.visit(self.tree)
-        assert not (set(visitor.calls) - set(visitor.nodes))
-        for node in visitor.nodes:
-            text = node.value
-            if sys.version_info[0] > 2 and isinstance(text, bytes):
+        changed = [_get_new_range(hunk) for hunk in hunks]
+        positions = set()
+        checked = set()
+        results = []
+        for literal in visitor.literals:
+            records = [literal]
+            if literal.call is not None:
+                records.append(literal.call)
+            record_positions = set((record.lineno, record.col_offset)
+                                   for record in records)
+            positions.update(record_positions)
+            if (literal.is_docstring or literal.is_constant or
+                    any(_overlaps(record, changed) for record in records)):
+                checked.update(record_positions)
+                results.extend(self._check_literal(literal))
+
+        for error in previous:
+            line = _shift_line(error[0], hunks)
+            # Only reuse errors of nodes which still exist and are unchanged
+            if (line is not None and (line, error[1]) in positions and
+                    (line, error[1]) not in checked):
+                results.append((line, error[1], error[2], type(self)))
+        return sorted(results, key=lambda error: error[:2])
+
+    def _get_string(self, text, is_format):
+        """Return the text of a str or bytes value or None to skip it."""
+        if isinstance(text, bytes):
+            if self._encoding is None:
+                self._encoding = _get_declared_encoding(self.lines or [])
+            return _decode_bytes(text, is_format, self._encoding)
+        return text
+
+    def _get_field_kinds(self, fields):
+        """Return the numbers and names of the fields, shared if cached."""
+        if not fields:
+            return self._NO_FIELDS[0], self._NO_FIELDS[0]
+        # The fields are only a set if they are not from the cache
+        fields = frozenset(fields)
+        kinds = self._field_kinds_cache.get(fields)
+        if kinds is not None:
+            return kinds
+        numbers = set()
+        names = set()
+        # Determine which fields require a keyword and which an arg
+        for field in fields:
+            name, number = _split_field_name(field)
+            if number is None:
+                names.add(name)
+            else:
+                numbers.add(number)
+        kinds = frozenset(numbers), frozenset(names)
+        self._field_kinds_cache.put(fields, kinds)
+        return kinds
+
+    def _check_template(self, template, shape):
+        """Return the error messages of the template as a tuple."""
+        text = self._get_string(template, shape is not None)
+        if text is None:
+            return ()
+        fields, implicit, explicit = self.get_fields(text)
+        if shape is None:
+            return (self._get_message(103, {}),) if implicit else ()
+        errors = [(101, {})] if implicit else []
+        errors += self._get_call_errors(text, fields, implicit, explicit,
+                                        shape.args, shape.keywords,
+                                        shape.starargs, shape.kwargs)
+        return tuple(self._get_message(code, params)
+                     for code, params in errors)
+
+    def _get_call_errors(self, text, fields, implicit, explicit, num_args,
+                         keywords, has_starargs, has_kwargs):
+        """
+        Return the codes and parameters of the errors of a format call.
+
+        The errors only depend on the template and the shape of the arguments,
+        so they are shared by all calls checked in the same process.
+        """
+        has_starargs = bool(has_starargs)
+        has_kwargs = bool(has_kwargs)
+        key = text, num_args, keywords, has_starargs, has_kwargs
+        errors = self._call_cache.get(key)
+        if errors is None:
+            errors = tuple(self._analyse_call(
+                fields, implicit, explicit, num_args, keywords, has_starargs,
+                has_kwargs))
+            self._call_cache.put(key, errors)
+        return errors
+
+    def _analyse_call(self, fields, implicit, explicit, num_args, keywords,
+                      has_starargs, has_kwargs):
+        """Yield the code and parameters of each error of a format call."""
+        numbers, names = self._get_field_kinds(fields)
+
+        # if starargs or kwargs is not None, it can't count the
+        # parameters but at least check if the args are used
+        if has_kwargs:
+            if not names:
+                # No names but kwargs
+                yield 203, {}
+        if has_starargs:
+            if not numbers:
+                # No numbers but args
+                yield 204, {}
+
+        if not has_kwargs and not has_starargs:
+            # can actually verify numbers and names
+            for number in sorted(numbers):
+                if number >= num_args:
+                    yield 201, {'idx': number}
+
+            for name in sorted(names):
+                if name not in keywords:
+                    yield 202, {'kw': name}
+
+        for arg in range(num_args):
+            if arg not in numbers:
+                yield 301, {'idx': arg}
+
+        for keyword in sorted(keywords):
+            if keyword not in names:
+                yield 302, {'kw': keyword}
+
+        if implicit and explicit:
+            yield 205, {}
+
+
+# Statements which are not expressions and don't start a block
+_SIMPLE_STATEMENTS = frozenset([
+    'assert', 'break', 'continue', 'del', 'from', 'global', 'import',
+    'nonlocal', 'pass', 'raise', 'return'])
+# Statements which start a block
+_COMPOUND_STATEMENTS = frozenset([
+    'async', 'class', 'def', 'elif', 'else', 'except', 'finally', 'for', 'if',
+    'try', 'while', 'with'])
+_AUGMENTED_ASSIGNMENTS = frozenset([
+    '+=', '-=', '*=', '/=', '//=', '%=', '@=', '&=', '|=', '^=', '>>=', '<<=',
+    '**='])
+_SKIPPED_TOKENS = frozenset([
+    tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+    tokenize.DEDENT, tokenize.ENDMARKER])
+
+
+def _is_op(token, string):
+    return token[0] == tokenize.OP and token[1] == string
+
+
+def _find_closing(tokens, index):
+    """Return the index of the bracket closing the one at the index."""
+    depth = 0
+    for index in range(index, len(tokens)):
+        if tokens[index][0] == tokenize.OP:
+            if tokens[index][1] in ('(', '[', '{'):
+                depth += 1
+            elif tokens[index][1] in (')', ']', '}'):
+                depth -= 1
+                if depth == 0:
+                    return index
+    return len(tokens)
+
+
+def _split_top_level(tokens, separator):
+    """Split the tokens at each separator which is not inside brackets."""
+    parts = [[]]
+    depth = 0
+    for token in tokens:
+        if token[0] == tokenize.OP:
+            if token[1] in ('(', '[', '{'):
+                depth += 1
+            elif token[1] in (')', ']', '}'):
+                depth -= 1
+            elif depth == 0 and token[1] == separator:
+                parts.append([])
+                continue
+        parts[-1].append(token)
+    return parts
+
+
+def _top_level(tokens):
+    """Yield all tokens which are not inside brackets."""
+    depth = 0
+    for token in tokens:
+        if token[0] == tokenize.OP and token[1] in (')', ']', '}'):
+            depth -= 1
+        if depth == 0:
+            yield token
+        if token[0] == tokenize.OP and token[1] in ('(', '[', '{'):
+            depth += 1
+
+
+def _follows_operand(tokens, index):
+    """Return whether the token at the index directly follows an operand."""
+    if index == 0:
+        return False
+    previous = tokens[index - 1]
+    if previous[0] == tokenize.NAME:
+        return (not iskeyword(previous[1]) or
+                previous[1] in ('None', 'True', 'False'))
+    return (previous[0] == tokenize.STRING or
+            _is_op(previous, ')') or _is_op(previous, ']'))
+
+
+class _TokenChecker(StringFormatChecker):
+
+    """
+    Checker which only uses the tokens of a logical line.
+
+    It finds the strings and calls to format like the checker using the tree.
+    Only if the arguments of a call cannot be determined from the tokens, the
+    call itself is parsed.
+    """
+
+    def __init__(self, tokens, previous_logical):
+        super(_TokenChecker, self).__init__(None, None)
+        self.tokens = [token for token in tokens
+                       if token[0] not in _SKIPPED_TOKENS]
+        self.previous_logical = previous_logical
+
+    def _run(self):
+        tokens = self.tokens
+        first = tokens[0][1] if tokens else None
+        is_definition = first in ('def', 'class')
+        # Like the body of the module, a class or a function
+        is_body_start = (not self.previous_logical or (
+            self.previous_logical.split(_SPACE, 1)[0] in ('def', 'class') and
+            self.previous_logical.endswith(_COLON)))
+        if first in _COMPOUND_STATEMENTS:
+            index = len(_split_top_level(tokens, ':')[0])
+            header, tokens = tokens[:index + 1], tokens[index + 1:]
+            # Decorators and the body of definitions are checked only
+            if not is_definition:
+                for error in self._check_tokens(header):
+                    yield error
+            is_body_start = is_definition
+        elif first == '@':
+            for error in self._check_tokens(tokens):
+                yield error
+            return
+
+        for statement in _split_top_level(tokens, ';'):
+            if statement:
+                for error in self._check_statement(statement, is_body_start):
+                    yield error
+            is_body_start = False
+
+    def _check_statement(self, tokens, is_body_start):
+        first = tokens[0]
+        if first[0] == tokenize.NAME and first[1] in _SIMPLE_STATEMENTS:
+            return self._check_tokens(tokens)
+        is_lambda = False
+        for token in _top_level(tokens):
+            if token[0] == tokenize.NAME and token[1] == 'lambda':
+                is_lambda = True
+            elif token[0] == tokenize.OP and (
+                    token[1] == '=' or token[1] in _AUGMENTED_ASSIGNMENTS or
+                    (token[1] == ':' and not is_lambda)):
+                # An assignment
+                return self._check_tokens(tokens)
+
+        # An expression which is only checked if it is a call or docstring
+        start = 0
+        end = len(tokens)
+        while (_is_op(tokens[start], '(') and
+                _find_closing(tokens, start) == end - 1):
+            start += 1
+            end -= 1
+        if all(token[0] == tokenize.STRING for token in tokens[start:end]):
+            if is_body_start:
+                return self._check_tokens(tokens, docstring=True)
+        elif self._is_call(tokens):
+            return self._check_tokens(tokens)
+        return ()
+
+    def _is_call(self, tokens):
+        """Return whether the expression is a call."""
+        top_level = list(_top_level(tokens))
+        for token in top_level:
+            if token[0] == tokenize.NAME:
+                if iskeyword(token[1]) and token[1] not in ('None', 'True',
+                                                            'False'):
+                    return False
+            elif token[0] == tokenize.OP:
+                if token[1] not in ('.', '(', ')', '[', ']', '{', '}'):
+                    return False
+            elif token[0] not in (tokenize.STRING, tokenize.NUMBER):
+                return False
+        return (len(top_level) > 2 and _is_op(top_level[-1], ')') and
+                _follows_operand(top_level, len(top_level) - 2))
+
+    def _check_tokens(self, tokens, docstring=False):
+        index = 0
+        while index < len(tokens):
+            if tokens[index][0] != tokenize.STRING:
+                index += 1
+                continue
+            end = index
+            while end < len(tokens) and tokens[end][0] == tokenize.STRING:
+                end += 1
+            for error in self._check_string(tokens, index, end, docstring):
+                yield error
+            index = end
+
+    def _check_string(self, tokens, start, end, docstring):
+        string_tokens = tokens[start:end]
+        position = tokens[start][2]
+
+        # Determine whether it is "…".format(…) or str.format("…", …)
+        while (start > 0 and end < len(tokens) and
+                _is_op(tokens[start - 1], '(') and _is_op(tokens[end], ')') and
+                not _follows_operand(tokens, start - 1)):
+            start -= 1
+            end += 1
+        call = None
+        if (end + 2 < len(tokens) and _is_op(tokens[end], '.') and
+                tokens[end + 1][1] == 'format' and
+                _is_op(tokens[end + 2], '(')):
+            call = tokens[start][2], end + 2, False
+        elif (start >= 4 and end < len(tokens) and
+                (_is_op(tokens[end], ',') or _is_op(tokens[end], ')')) and
+                [token[1] for token in tokens[start - 4:start]] ==
+                ['str', '.', 'format', '('] and
+                (start == 4 or not _is_op(tokens[start - 5], '.'))):
+            call = tokens[start - 4][2], start - 1, True
+
+        if not self._is_checked(call is not None, docstring):
+            return
+        try:
+            value = ast.literal_eval(
+                _SPACE.join(token[1] for token in string_tokens))
+        except (SyntaxError, ValueError):
+            # For example formatted strings
+            return
+        text = self._get_string(value, call is not None)
+        if text is None:
+            return
+        fields, implicit, explicit = self.get_fields(text)
+        if implicit:
+            if call:
+                yield self._format_error(position, 101)
+            else:
+                yield self._format_error(position, 102 if docstring else 103)
+
+        if call and self._analyse_calls:
+            call_position, index, str_args = call
+            args = self._get_token_args(
+                tokens[index:_find_closing(tokens, index) + 1], str_args)
+            if args is None:
+                return
+            for code, params in self._get_call_errors(text, fields, implicit,
+                                                      explicit, *args):
+                yield self._format_error(call_position, code, **params)
+
+    def _get_token_args(self, tokens, str_args):
+        """Return the arguments of the call like ``_get_call_args``."""
+        args = [arg for arg in _split_top_level(tokens[1:-1], ',') if arg]
+        num_args = 0
+        keywords = []
+        has_starargs = 0
+        has_kwargs = False
+        for arg in args:
+            if any(token[0] == tokenize.NAME and token[1] == 'lambda'
+                   for token in _top_level(arg)):
+                # It can't separate the arguments of the lambda
+                return self._parse_args(tokens, str_args)
+            if _is_op(arg[0], '**'):
+                has_kwargs = True
+            elif _is_op(arg[0], '*'):
+                has_starargs += 1
+            elif (len(arg) > 1 and arg[0][0] == tokenize.NAME and
+                    _is_op(arg[1], '=')):
+                keywords.append(arg[0][1])
+            else:
+                num_args += 1
+        if str_args:
+            num_args -= 1
+        return num_args, frozenset(keywords), has_starargs, has_kwargs
+
+    def _parse_args(self, tokens, str_args):
+        try:
+            tree = ast.parse(
+                str('f') + _SPACE.join(token[1] for token in tokens),
+                mode='eval')
+        except SyntaxError:
+            return None
+        return _get_call_args(tree.body, str_args)
+
+    def _format_error(self, position, code, **params):
+        msg = self._get_message(code, params)
+        return position[0], position[1], msg, type(self)
+
+
+def check_tokens(logical_line, tokens, previous_logical):
+    """Check the logical line if the tokens mode is used."""
+    if StringFormatChecker._mode != 'tokens':
+        return
+    for line, col, msg, _ in _TokenChecker(tokens, previous_logical).run():
+        yield (line, col), msg
+
+
+check_tokens.name = StringFormatChecker.name
+check_tokens.version = StringFormatChecker.version
+
+
+class FormatShape(namedtuple('FormatShape',
+                             'args keywords starargs kwargs')):
+
+    """
+    The arguments a template is formatted with.
+
+    It is the number of positional arguments, the names of the keyword
+    arguments and whether there are variable positional and keyword
+    arguments.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, args=0, keywords=(), starargs=False, kwargs=False):
+        return super(FormatShape, cls).__new__(
+            cls, args, frozenset(keywords), bool(starargs), bool(kwargs))
+
+
+def check_templates(templates):
+    """
+    Check many templates and yield the errors of each of them.
+
+    Each item is either a template or a tuple of a template and the
+    ``FormatShape`` of the arguments it is formatted with. Without a shape it
+    is only checked for unindexed fields (FMT103), like any other string. With
+    a shape it is checked like a call to format.
+
+    For each item, in the same order, it yields the index of the item and the
+    list of error messages like ``'FMT301 format call provides unused index
+    (1)'``. Identical items are only analysed once. Bytes are decoded as
+    UTF-8.
+    """
+    checker = StringFormatChecker(None, 'templates')
+    verdicts = {}
+    for index, item in enumerate(templates):
+        if isinstance(item, tuple):
+            template, shape = item
+            if shape is not None and not isinstance(shape, FormatShape):
+                shape = FormatShape(*shape)
+        else:
+            template, shape = item, None
+        key = template, shape
+        errors = verdicts.get(key)
+        if errors is None:
+            errors = verdicts[key] = checker._check_template(template, shape)
+        yield index, list(errors)
+
+
+def _iter_logical_lines(lines):
+    """Yield the tokens and previous logical line of each logical line."""
+    previous_logical = ''
+    tokens = []
+    readline = functools.partial(next, iter(lines), '')
+    for token in tokenize.generate_tokens(readline):
+        tokens.append(token)
+        if token[0] in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            logical = [token[1] for token in tokens
+                       if token[0] not in _SKIPPED_TOKENS]
+            yield tokens, previous_logical
+            if logical:
+                previous_logical = _SPACE.join(logical)
+            tokens = []
+
+
+_NOQA_PATTERN = (
+    r'(?i)#\s*noqa(?::\s?(?P<codes>[A-Z][0-9]+(?:[,\s]+[A-Z][0-9]+)*))?')
+# Directories which Flake8 excludes by default
+_EXCLUDED_DIRECTORIES = frozenset([
+    '.svn', 'CVS', '.bzr', '.hg', '.git', '__pycache__', '.tox', '.nox',
+    '.eggs'])
+
+
+class _OptionAdapter(object):
+
+    """Register the options of the plugin with an argparse parser."""
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def add_option(self, *args, **kwargs):
+        kwargs.pop('parse_from_config', None)
+        self.parser.add_argument(*args, **kwargs)
+
+
+def _read_source(filename):
+    """Return the decoded content of the file."""
+    with open(filename, 'rb') as f:
+        source = f.read()
+    if sys.version_info[0] > 2:
+        encoding = tokenize.detect_encoding(io.BytesIO(source).readline)[0]
+        source = source.decode(encoding)
+    return source
+
+
+def _is_noqa(line, code):
+    match = re.search(_NOQA_PATTERN, line)
+    if not match:
+        return False
+    codes = match.group('codes')
+    return not codes or code in re.split(r'[,\s]+', codes.upper())
+
+
+def check_file(filename, source=None):
+    """
+    Check the file without Flake8.
+
+    It returns the filename and a sorted list of line, column (starting at 1)
+    and message of each error which is neither disabled nor marked with
+    ``# noqa``. If the source is given, it is checked instead of the content
+    of the file.
+    """
+    changes = StringFormatChecker._changes
+    if changes is not None and not changes.get(filename):
+        return filename, []
+    try:
+        if source is None:
+            source = _read_source(filename)
+        lines = source.splitlines(True)
+        if StringFormatChecker._mode == 'tokens':
+            results = [
+                error
+                for tokens, previous_logical in _iter_logical_lines(lines)
+                for error in _TokenChecker(tokens, previous_logical).run()]
+            if changes is not None:
+                ranges = changes.get(filename)
+                results = [error for error in results
+                           if any(start <= error[0] <= end
+                                  for start, end in ranges)]
+            if StringFormatChecker._baseline is not None:
+                results = StringFormatChecker._baseline.filter(
+                    filename, lines, results)
+        else:
+            tree = ast.parse(source, filename)
+            results = StringFormatChecker(tree, filename, lines).run()
+    except (SyntaxError, ValueError, UnicodeError, tokenize.TokenError) as e:
+        # Use the code and format of Flake8
+        line, col = getattr(e, 'lineno', 1) or 1, getattr(e, 'offset', 1) or 1
+        return filename, [(line, col, 'E999 {0}: {1}'.format(
+            type(e).__name__, getattr(e, 'msg', e)))]
+    except (IOError, OSError) as e:
+        return filename, [(1, 1, 'E902 {0}: {1}'.format(type(e).__name__, e))]
+
+    errors = []
+    for line, col, msg, _ in results:
+        code = msg.split(' ', 1)[0]
+        if int(code[3:]) not in StringFormatChecker._enabled_codes:
+            continue
+        if line <= len(lines) and _is_noqa(lines[line - 1], code):
+            continue
+        errors.append((line, col + 1, msg))
+    return filename, sorted(errors)
+
+
+def _iter_files(paths):
+    """Yield all Python files in the paths."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, directories, filenames in os.walk(path):
+            directories[:] = sorted(
+                directory for directory in directories
+                if directory not in _EXCLUDED_DIRECTORIES and
+                not directory.endswith('.egg'))
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(root, filename)
+
+
+class _Daemon(object):
+
+    """
+    Server which checks files on request and keeps its caches in memory.
+
+    Each request and response is a JSON object on a separate line. A request
+    has an ``id``, a ``method`` and ``params``. The ``check`` method requires
+    a ``filename`` and optionally the ``source`` to check instead of the file
+    and returns the ``filename`` and its ``errors``. The ``shutdown`` method
+    stops the server. The response has the ``id`` of the request and either a
+    ``result`` or an ``error``.
+
+    Besides the caches of the checker it keeps the errors of each file and
+    only checks it again if the source changed. As the constants of imported
+    modules may change independently, that is not done with constants.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def check(self, filename, source=None):
+        """Return the errors of the file, checking it only if changed."""
+        if source is None:
+            try:
+                source = _read_source(filename)
+            except (IOError, OSError, SyntaxError, UnicodeError):
+                # Let check_file report the error
+                return check_file(filename)[1]
+        if StringFormatChecker._constant_index is not None:
+            return check_file(filename, source)[1]
+        digest = _ResultCache.key(source, StringFormatChecker._enabled_codes)
+        result = self.results.get(filename)
+        if result is None or result[0] != digest:
+            result = self.results[filename] = (
+                digest, check_file(filename, source)[1])
+        return result[1]
+
+    def handle(self, request):
+        """Return the response to the request and whether to stop."""
+        response = {'id': request.get('id')}
+        method = request.get('method')
+        params = request.get('params') or {}
+        if method == 'check' and 'filename' in params:
+            response['result'] = {
+                'filename': params['filename'],
+                'errors': self.check(params['filename'],
+                                     params.get('source'))}
+        elif method == 'shutdown':
+            response['result'] = None
+            return response, True
+        else:
+            response['error'] = 'Invalid request'
+        return response, False
+
+    def serve(self, infile, outfile):
+        """
+        Answer the requests from the binary file until it ends.
+
+        It returns whether the server was asked to shut down.
+        """
+        import json
+        for line in iter(infile.readline, b''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('Expected an object')
+            except ValueError as e:
+                response, stop = {'id': None, 'error': str(e)}, False
+            else:
+                response, stop = self.handle(request)
+            outfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            outfile.flush()
+            if stop:
+                return True
+        return False
+
+    def serve_socket(self, path):
+        """
+        Answer the requests of one connection after the other.
+
+        A socket left behind at the path is replaced, but neither any other
+        file nor the socket of a running daemon. It returns the exit status.
+        """
+        import socket
+        import stat
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                print('Cannot listen at {0}: it exists and is not a '
+                      'socket'.format(path), file=sys.stderr)
+                return 2
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(path)
+            except socket.error:
+                # Nothing listens on it anymore
+                os.remove(path)
+            else:
+                print('Cannot listen at {0}: another daemon is listening on '
+                      'it'.format(path), file=sys.stderr)
+                return 2
+            finally:
+                client.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen(5)
+            stop = False
+            while not stop:
+                connection = server.accept()[0]
                 try:
-                    # TODO: Maybe decode using file encoding?
-                    text = text.decode('ascii')
-                except UnicodeDecodeError as e:
-                    continue
-            fields, implicit, explicit = self.get_fields(text)
-            if implicit:
-                if node in visitor.calls:
-                    assert not node.is_docstring
-                    yield self._generate_error(node, 101)
-                else:
-                    yield self._generate_unindexed(node)
-
-            if node in visitor.calls:
-                call, str_args = visitor.calls[node]
-
-                numbers = set()
-                names = set()
-                # Determine which fields require a keyword and which an arg
-                for name in fields:
-                    field_match = self.FIELD_REGEX.match(name)
-                    try:
-                        number = int(field_match.group(1))
-                    except ValueError:
-                        number = -1
-                    # negative numbers are considered keywords
-                    if number >= 0:
-                        numbers.add(number)
-                    else:
-                        names.add(field_match.group(1))
-
-                keywords = set(keyword.arg for keyword in call.keywords)
-                num_args = len(call.args)
-                if str_args:
-                    num_args -= 1
-                if sys.version_info < (3, 5):
-                    has_kwargs = bool(call.kwargs)
-                    has_starargs = bool(call.starargs)
-                else:
-                    # With Python version 3.5 the location and number of
-                    # kwargs/starargs has been relaxed
-                    has_kwargs = None in keywords
-                    has_starargs = sum(1 for arg in call.args
-                                       if isinstance(arg, ast.Starred))
-
-                    if has_kwargs:
-                        keywords.discard(None)
-                    if has_starargs:
-                        num_args -= has_starargs
-
-                # if starargs or kwargs is not None, it can't count the
-                # parameters but at least check if the args are used
-                if has_kwargs:
-                    if not names:
-                        # No names but kwargs
-                        yield self._generate_error(call, 203)
-                if has_starargs:
-                    if not numbers:
-                        # No numbers but args
-                        yield self._generate_error(call, 204)
-
-                if not has_kwargs and not has_starargs:
-                    # can actually verify numbers and names
-                    for number in sorted(numbers):
-                        if number >= num_args:
-                            yield self._generate_error(call, 201, idx=number)
-
-                    for name in sorted(names):
-                        if name not in keywords:
-                            yield self._generate_error(call, 202, kw=name)
-
-                for arg in range(num_args):
-                    if arg not in numbers:
-                        yield self._generate_error(call, 301, idx=arg)
-
-                for keyword in keywords:
-                    if keyword not in names:
-                        yield self._generate_error(call, 302, kw=keyword)
-
-
-                if implicit and explicit:
-                    yield self._generate_error(call, 205)
+                    stop = self.serve(connection.makefile('rb'),
+                                      connection.makefile('wb'))
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(path)
+        return 0
+
+
+def _run_client(path, filenames):
+    """Let the daemon check the files and print the errors like Flake8."""
+    import json
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error as e:
+        print('Cannot connect to the daemon at {0}: {1}'.format(path, e),
+              file=sys.stderr)
+        return 2
+    status = 0
+    try:
+        infile = client.makefile('rb')
+        outfile = client.makefile('wb')
+        for request_id, filename in enumerate(filenames):
+            request = {'id': request_id, 'method': 'check',
+                       'params': {'filename': os.path.abspath(filename)}}
+            outfile.write(json.dumps(request).encode('utf-8') + b'\n')
+            outfile.flush()
+            response = json.loads(infile.readline().decode('utf-8') or 'null')
+            if not response or 'error' in response:
+                print('The daemon failed to check {0}: {1}'.format(
+                    filename, response and response['error']),
+                    file=sys.stderr)
+                return 2
+            for line, col, msg in response['result']['errors']:
+                status = 1
+                print('{0}:{1}:{2}: {3}'.format(filename, line, col, msg))
+    finally:
+        client.close()
+    return status
+
+
+def _init_worker(options):
+    StringFormatChecker.parse_options(options)
+
+
+def main(argv=None):
+    """Check files in parallel without Flake8 and print the errors."""
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(
+        prog='python -m flake8_string_format', description=main.__doc__)
+    parser.add_argument('paths', nargs='*', default=['.'],
+                        help='files and directories to check')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--first-error', action='store_true',
+                        help='stop after the first file with errors')
+    parser.add_argument('--select', default=None,
+                        help='comma separated list of codes to report')
+    parser.add_argument('--ignore', default=None,
+                        help='comma separated list of codes to ignore')
+    parser.add_argument('--daemon', action='store_true',
+                        help='answer check requests from stdin or the socket '
+                             'with warm caches instead of checking the paths')
+    parser.add_argument('--socket', default=None, metavar='PATH',
+                        help='Unix socket on which the daemon listens; '
+                             'without --daemon the paths are checked by the '
+                             'daemon listening on it')
+    parser.add_argument('--write-baseline', default=None, metavar='FILE',
+                        help='write the errors of the paths into this file '
+                             'instead of printing them, to use it with '
+                             '--fmt-baseline')
+    StringFormatChecker.add_options(_OptionAdapter(parser))
+    options = parser.parse_args(argv)
+
+    if options.daemon and options.fmt_diff_base:
+        # The changes are only read once, but the files keep changing
+        parser.error('--fmt-diff-base cannot be used with --daemon')
+    if options.socket and not options.daemon:
+        # The options of the daemon are used
+        return _run_client(options.socket, list(_iter_files(options.paths)))
+    baseline = None
+    if options.write_baseline:
+        # All errors are written, including the ones of the old baseline
+        options.fmt_baseline = None
+        baseline = _Baseline(options.write_baseline)
+    StringFormatChecker.parse_options(options)
+    if options.daemon:
+        if options.socket:
+            return _Daemon().serve_socket(options.socket)
+        _Daemon().serve(getattr(sys.stdin, 'buffer', sys.stdin),
+                        getattr(sys.stdout, 'buffer', sys.stdout))
+        return 0
+
+    filenames = list(_iter_files(options.paths))
+    pool = None
+    # Starting processes costs more than checking a few files
+    jobs = min(options.jobs or multiprocessing.cpu_count(), len(filenames))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (options,))
+        results = pool.imap_unordered(check_file, filenames)
+    else:
+        results = (check_file(filename) for filename in filenames)
+
+    status = 0
+    written = 0
+    try:
+        for filename, errors in results:
+            if baseline is not None:
+                errors = [error for error in errors
+                          if error[2].startswith('FMT')]
+                if errors:
+                    baseline.add(filename,
+                                 _read_source(filename).splitlines(True),
+                                 errors)
+                    written += len(errors)
+                continue
+            for line, col, msg in errors:
+                print('{0}:{1}:{2}: {3}'.format(filename, line, col, msg))
+            if errors:
+                status = 1
+                if options.first_error:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if baseline is not None:
+        baseline.save(options.write_baseline)
+        print('Wrote {0} errors in {1} files to {2}'.format(
+            written, len(baseline.files), options.write_baseline))
+        return 0
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,6 +32,7 @@ setup(
     entry_points={
         'flake8.extension': [
             'FMT = flake8_string_format:StringFormatChecker',
+            'FMT1 = flake8_string_format:check_tokens',
         ],
     },
     tests_require=['six'],
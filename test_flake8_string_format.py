@@ -2,12 +2,21 @@ from __future__ import print_function
 
 import ast
 import codecs
+import difflib
+import gc
+import io
 import itertools
+import json
 import optparse
 import os
 import re
+import shutil
+import socket
 import sys
 import tempfile
+import threading
+import tokenize
+import weakref
 
 PY26 = sys.version_info[:2] == (2, 6)
 
@@ -18,9 +27,16 @@ else:
 
 from collections import defaultdict
 from subprocess import Popen, PIPE
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 import six
 
+import benchmark
 import flake8_string_format
 
 
@@ -162,6 +178,1339 @@ class TestSimple(SimpleImportTestCase):
         self.run_code(dynamic_code, dynamic_positions, 'fn')
 
 
+def run_tokens(code):
+    """Run the tokens checker on each logical line like Flake8."""
+    for tokens, previous_logical in flake8_string_format._iter_logical_lines(
+            code.splitlines(True)):
+        checker = flake8_string_format._TokenChecker(tokens, previous_logical)
+        for result in checker.run():
+            yield result
+
+
+class TestTokens(TestCaseBase):
+
+    def run_code(self, code, positions):
+        self.compare_results(run_tokens(code), positions)
+
+    def test_dynamic(self):
+        self.run_code(dynamic_code, dynamic_positions)
+
+    def test_statements(self):
+        self.run_code('"{}"\n'
+                      'x = 1; "{}"\n'
+                      '("{}" "x").format(1, 2)\n'
+                      'str.format(("{a}"), *x)\n'
+                      '"{0}".format(a=lambda x, y: 1) + 2\n'
+                      '"{0}".format(lambda x, y: 1, 2)\n'
+                      'def f(x="{}"): "{}"\n'
+                      'if x == "{}": y = "{}"\n'
+                      'async def g(x="{}"):\n'
+                      '    "{}"\n',
+                      [(1, 0, 'FMT102'), (3, 1, 'FMT101'),
+                       (3, 0, 'FMT301'), (4, 0, 'FMT204'),
+                       (6, 0, 'FMT301'), (7, 15, 'FMT102'),
+                       (8, 8, 'FMT103'), (8, 18, 'FMT103'),
+                       (9, 14, 'FMT103')])
+
+    def test_lambda_fallback(self):
+        checker = flake8_string_format._TokenChecker([], '')
+        # Only Python 3 adds a newline to the end of the source
+        tokens = [token for token in tokenize.generate_tokens(
+            six.StringIO('(lambda a, b: a, *c, d=1, **e)').readline)
+            if token[0] not in (tokenize.NEWLINE, tokenize.ENDMARKER)]
+        self.assertEqual(checker._get_token_args(tokens, False),
+                         (1, set(['d']), 1, True))
+
+
+class TestTextVisitor(unittest.TestCase):
+
+    def test_tree_not_modified(self):
+        tree = ast.parse(dynamic_code)
+        before = ast.dump(tree, include_attributes=True)
+        visitor = flake8_string_format.TextVisitor()
+        visitor.visit(tree)
+        self.assertEqual(ast.dump(tree, include_attributes=True), before)
+        for node in ast.walk(tree):
+            self.assertFalse(hasattr(node, 'is_docstring'))
+
+    def test_docstrings(self):
+        tree = ast.parse('"""Module."""\n'
+                         'def f():\n    """Function."""\n    "Other"\n')
+        visitor = flake8_string_format.TextVisitor()
+        visitor.visit(tree)
+        self.assertEqual(
+            sorted(literal.value for literal in visitor.literals
+                   if literal.is_docstring),
+            ['Function.', 'Module.'])
+        self.assertEqual(len(visitor.literals), 2)
+
+    def test_records(self):
+        tree = ast.parse('x = 1\ny = "{0} {a}".format(\n  1, *z, a=2)\n')
+        visitor = flake8_string_format.TextVisitor()
+        visitor.visit(tree)
+        self.assertEqual(len(visitor.literals), 1)
+        literal = visitor.literals[0]
+        self.assertFalse(hasattr(literal, '__dict__'))
+        self.assertEqual((literal.lineno, literal.col_offset, literal.value),
+                         (2, 4, '{0} {a}'))
+        call = literal.call
+        self.assertFalse(hasattr(call, '__dict__'))
+        self.assertEqual((call.lineno, call.col_offset), (2, 4))
+        self.assertEqual(call.num_args, 1)
+        self.assertEqual(call.keywords, frozenset(['a']))
+        self.assertTrue(call.has_starargs)
+        self.assertFalse(call.has_kwargs)
+        self.assertEqual(call.end_lineno, 3)
+
+    def test_tree_released(self):
+        tree = ast.parse('"{0}".format(1)\n')
+        reference = weakref.ref(tree)
+        visitor = flake8_string_format.TextVisitor()
+        visitor.visit(tree)
+        del tree
+        gc.collect()
+        self.assertIsNone(reference())
+        self.assertEqual(len(visitor.literals), 1)
+
+    def test_import_without_warnings(self):
+        """Verify no deprecated node classes are used at import."""
+        process = Popen([sys.executable, '-W', 'error::DeprecationWarning',
+                         '-c', 'import flake8_string_format'],
+                        stdout=PIPE, stderr=PIPE)
+        stderr = process.communicate()[1]
+        self.assertEqual((process.returncode, stderr), (0, b''))
+
+
+class CountingChecker(flake8_string_format.StringFormatChecker):
+
+    """Checker which counts how often the source was actually analysed."""
+
+    analysed = 0
+
+    def _run(self):
+        CountingChecker.analysed += 1
+        return super(CountingChecker, self)._run()
+
+
+class TestResultCache(SimpleImportTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        CountingChecker.analysed = 0
+
+    def create_checker(self, code, cache):
+        checker = CountingChecker(ast.parse(code), 'fn',
+                                  code.splitlines(True))
+        checker._result_cache = cache
+        return checker
+
+    def test_cached_results(self):
+        cache = flake8_string_format._ResultCache(self.directory, 10)
+        for expected_analysed in [1, 1]:
+            checker = self.create_checker(dynamic_code, cache)
+            results = list(checker.run())
+            self.assertEqual(CountingChecker.analysed, expected_analysed)
+            for result in results:
+                self.assertIs(result[3], CountingChecker)
+            self.compare_results(results, dynamic_positions)
+
+    def test_changed_source(self):
+        cache = flake8_string_format._ResultCache(self.directory, 10)
+        list(self.create_checker('"{}"\n', cache).run())
+        results = list(self.create_checker('x = "{}"\n', cache).run())
+        self.assertEqual(CountingChecker.analysed, 2)
+        self.compare_results(results, [(1, 4, 'FMT103')])
+
+    def test_lru_eviction(self):
+        cache = flake8_string_format._ResultCache(self.directory, 2)
+        cache.put('a', [(1, 0, 'a')])
+        cache.put('b', [(1, 0, 'b')])
+        # Make sure that 'a' is used more recently than 'b'
+        os.utime(os.path.join(self.directory, 'b.json'), (0, 0))
+        self.assertEqual(cache.get('a'), [(1, 0, 'a')])
+        cache.put('c', [(1, 0, 'c')])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), [(1, 0, 'a')])
+        self.assertEqual(cache.get('c'), [(1, 0, 'c')])
+
+    def test_evict_to_low_water(self):
+        cache = flake8_string_format._ResultCache(self.directory, 20)
+        self.assertEqual(cache.evict_interval, 2)
+        for index in range(25):
+            path = os.path.join(self.directory, '{0}.json'.format(index))
+            open(path, 'w').close()
+            os.utime(path, (index, index))
+        cache._evict()
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted('{0}.json'.format(index) for index in range(7, 25)))
+        # Nothing is removed below the maximum
+        cache._evict()
+        self.assertEqual(len(os.listdir(self.directory)), 18)
+
+    def test_switch_mode(self):
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_mode', checker._mode)
+        cache = flake8_string_format._ResultCache(self.directory, 10)
+        code = 'x = "{}"\n"{0}".format(1, 2)\n'
+        checker._mode = 'tokens'
+        self.assertEqual(list(self.create_checker(code, cache).run()), [])
+        self.assertEqual(os.listdir(self.directory), [])
+        checker._mode = 'ast'
+        results = list(self.create_checker(code, cache).run())
+        self.compare_results(results, [(1, 4, 'FMT103'), (2, 0, 'FMT301')])
+
+    def test_enabled_codes_in_key(self):
+        key = flake8_string_format._ResultCache.key
+        self.assertNotEqual(key('"{}"', [101, 102]), key('"{}"', [101]))
+        self.assertEqual(key('"{}"', [102, 101]), key('"{}"', [101, 102]))
+
+    def test_interpreter_in_key(self):
+        key = flake8_string_format._ResultCache.key
+        current = key('"{}"', [101])
+        self.addCleanup(setattr, sys, 'version_info', sys.version_info)
+        sys.version_info = (sys.version_info[0], sys.version_info[1] + 1, 0)
+        self.assertNotEqual(key('"{}"', [101]), current)
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_parse_cache',
+                        checker._parse_cache)
+        checker._parse_cache = flake8_string_format._LRUCache(2)
+        self.checker = checker(ast.parse(''), 'fn')
+
+    def test_counters(self):
+        cache = self.checker._parse_cache
+        self.assertEqual(self.checker.get_fields('{1} {}'),
+                         (frozenset(['0', '1']), True, True))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.checker.get_fields('{1} {}')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Strings without braces are not even looked up
+        self.checker.get_fields('no fields')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_immutable(self):
+        fields = self.checker.get_fields('{a}')[0]
+        self.assertRaises(AttributeError, getattr, fields, 'add')
+        self.assertEqual(self.checker.get_fields('{a}')[0], frozenset(['a']))
+
+    def test_size_bound(self):
+        cache = self.checker._parse_cache
+        for string in ['{a}', '{b}', '{a}', '{c}']:
+            self.checker.get_fields(string)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('{b}'))
+        self.assertIsNotNone(cache.get('{a}'))
+
+    def test_disabled(self):
+        cache = flake8_string_format._LRUCache(0)
+        cache.put('{a}', 42)
+        self.assertIsNone(cache.get('{a}'))
+        self.assertEqual(len(cache), 0)
+
+
+class TestCallCache(unittest.TestCase):
+
+    def setUp(self):
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_call_cache', checker._call_cache)
+        checker._call_cache = flake8_string_format._LRUCache(4096)
+        self.cache = checker._call_cache
+
+    def run_checker(self, code):
+        return [error[2] for error in flake8_string_format.StringFormatChecker(
+            ast.parse(code), 'fn').run()]
+
+    def test_shared(self):
+        self.assertEqual(self.run_checker('"{0} {a}".format(1, 2)'), [
+            'FMT202 format call uses missing keyword (a)',
+            'FMT301 format call provides unused index (1)'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        self.assertEqual(
+            self.run_checker('"{0} {a}".format(x, y)\n'
+                             'str.format("{0} {a}", 3, 4)'),
+            ['FMT202 format call uses missing keyword (a)',
+             'FMT301 format call provides unused index (1)'] * 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_shape(self):
+        self.run_checker('"{0} {a}".format(1, a=2)')
+        self.assertEqual(self.run_checker('"{0} {a}".format(1, b=2)'), [
+            'FMT202 format call uses missing keyword (a)',
+            'FMT302 format call provides unused keyword (b)'])
+        self.assertEqual(self.run_checker('"{0} {a}".format(1, 2, a=2)'),
+                         ['FMT301 format call provides unused index (1)'])
+        self.assertEqual(self.cache.misses, 3)
+        # Only whether there are variable arguments matters
+        self.run_checker('"{0} {a}".format(*x, a=2)')
+        if sys.version_info >= (3, 5):
+            self.run_checker('"{0} {a}".format(*x, *y, a=2)')
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 4))
+
+    def test_disabled(self):
+        checker = flake8_string_format.StringFormatChecker
+        checker._call_cache = flake8_string_format._LRUCache(0)
+        for _ in range(2):
+            self.assertEqual(self.run_checker('"{0}".format(1, 2)'),
+                             ['FMT301 format call provides unused index (1)'])
+        self.assertEqual(len(checker._call_cache), 0)
+
+
+class TestScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = flake8_string_format.StringFormatChecker(
+            ast.parse(''), 'fn')
+
+    def assertSame(self, string):
+        self.assertEqual(self.checker._scan_fields(string),
+                         benchmark.parse_fields(string), repr(string))
+
+    def test_nested(self):
+        self.assertEqual(self.checker._scan_fields('{0:{1}.{prec}} {}'),
+                         ({'0', '1', 'prec'}, True, True))
+        self.assertEqual(self.checker._scan_fields('{a!x} {b!r:>{}}'),
+                         ({'b', ''}, False, True))
+
+    def test_invalid(self):
+        for string in ['{', '}', '{0', '{0!}', '{0:{{}}}', '{0:{1:{2}}}']:
+            self.assertSame(string)
+        self.assertEqual(self.checker._scan_fields('{0} }'),
+                         (set(), False, False))
+
+    def test_same_as_parse(self):
+        for length in range(6):
+            for chars in itertools.product('{}!:0[', repeat=length):
+                self.assertSame(''.join(chars))
+
+    def test_generated(self):
+        for seed in range(20):
+            self.assertSame(benchmark.generate_template(50, seed))
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'bytes are str on Python 2')
+class TestBytes(unittest.TestCase):
+
+    def test_region(self):
+        decode = flake8_string_format._decode_bytes
+        self.assertEqual(decode(b'\x00' * 1000 + b'{0}' + b'\xff', False,
+                                'utf-8'), '{0}')
+        self.assertEqual(decode(b'\xff} {0} x', False, 'utf-8'), '} {0}')
+        self.assertEqual(decode(b'{\xff}', False, 'utf-8'), '{\ufffd}')
+        self.assertIsNone(decode(b'\xff}', False, 'utf-8'))
+        self.assertEqual(decode(b'\xff}', True, 'utf-8'), '}')
+        self.assertEqual(decode(b'\xff', True, 'utf-8'), '')
+
+    def test_multibyte_encoding(self):
+        # The second byte of this character is the byte of a closing brace
+        text = '\u30de{0}'.encode('shift_jis')
+        self.assertEqual(text[1:2], b'}')
+        self.assertEqual(
+            flake8_string_format._decode_bytes(text, False, 'shift_jis'),
+            '\u30de{0}')
+
+    def test_declared_encoding(self):
+        get_encoding = flake8_string_format._get_declared_encoding
+        self.assertEqual(get_encoding(['# -*- coding: latin-1 -*-\n']),
+                         'iso8859-1')
+        self.assertEqual(get_encoding(['#!/usr/bin/python\n',
+                                       '# coding=cp1252\n']), 'cp1252')
+        self.assertEqual(get_encoding(['x = 1\n', '# coding=cp1252\n']),
+                         'utf-8')
+        self.assertEqual(get_encoding(['# coding: unknown\n']), 'utf-8')
+        self.assertEqual(get_encoding([]), 'utf-8')
+
+    def test_checker(self):
+        lines = ['# coding: latin-1\n', 'b"\\xe9{a}".format(1)\n',
+                 'x = b"\\xff{}"\n']
+        checker = flake8_string_format.StringFormatChecker(
+            ast.parse(''.join(lines)), 'fn', lines)
+        self.assertEqual([(error[0], error[2][:6]) for error in checker.run()],
+                         [(2, 'FMT202'), (2, 'FMT301'), (3, 'FMT103')])
+
+
+class TestFieldName(unittest.TestCase):
+
+    # The expression which was used before to get the first name
+    FIELD_REGEX = re.compile(r'^((?:\s|.)*?)(\..*|\[.*\])?$')
+
+    def assertFast(self, field, budget=0.1):
+        start = default_timer()
+        flake8_string_format._split_field_name(field)
+        self.assertLess(default_timer() - start, budget)
+
+    def test_split(self):
+        split = flake8_string_format._split_field_name
+        self.assertEqual(split('0'), ('0', 0))
+        self.assertEqual(split('12.real'), ('12', 12))
+        self.assertEqual(split('a[0]'), ('a', None))
+        self.assertEqual(split('a[0'), ('a[0', None))
+        self.assertEqual(split('a[0].b'), ('a[0]', None))
+        self.assertEqual(split('-1'), ('-1', None))
+        self.assertEqual(split(' 1 '), (' 1 ', 1))
+
+    def test_same_as_regex(self):
+        for length in range(6):
+            for chars in itertools.product('1.[]\n', repeat=length):
+                field = ''.join(chars)
+                self.assertEqual(
+                    flake8_string_format._split_field_name(field)[0],
+                    self.FIELD_REGEX.match(field).group(1), repr(field))
+
+    def test_pathological(self):
+        self.assertFast('a' * 100000)
+        self.assertFast('[' * 100000)
+        self.assertFast('.' * 100000)
+        self.assertFast('[a]' * 30000 + 'x')
+        self.assertFast('a\n' * 50000)
+        self.assertFast('1' * 100000)
+
+    def test_pathological_call(self):
+        field = '[a]' * 30000 + 'x'
+        checker = flake8_string_format.StringFormatChecker(
+            ast.parse('"{{{0}}}".format(1)'.format(field)), 'fn')
+        start = default_timer()
+        self.assertEqual([error[2][:6] for error in checker.run()],
+                         ['FMT202', 'FMT301'])
+        self.assertLess(default_timer() - start, 0.5)
+
+
+class TestTemplates(unittest.TestCase):
+
+    def check(self, *templates):
+        results = list(flake8_string_format.check_templates(templates))
+        self.assertEqual([index for index, _ in results],
+                         list(range(len(templates))))
+        return [[msg[:6] for msg in errors] for _, errors in results]
+
+    def test_without_shape(self):
+        self.assertEqual(
+            self.check('{}', '{0} {a}', 'plain', b'{}', b'\xff{}'),
+            [['FMT103'], [], [], ['FMT103'], ['FMT103']])
+
+    def test_with_shape(self):
+        shape = flake8_string_format.FormatShape
+        self.assertEqual(
+            self.check(('{0} {a}', shape(2, ['b'])),
+                       ('{}', shape(1)),
+                       ('{0}', (1,)),
+                       ('{0}', shape(starargs=True)),
+                       ('{a}', shape(kwargs=True)),
+                       ('{}', None)),
+            [['FMT202', 'FMT301', 'FMT302'], ['FMT101'], [], [], [],
+             ['FMT103']])
+
+    def test_messages(self):
+        shape = flake8_string_format.FormatShape(0, ['b', 'a'])
+        self.assertEqual(
+            list(flake8_string_format.check_templates([('', shape)])),
+            [(0, ['FMT302 format call provides unused keyword (a)',
+                  'FMT302 format call provides unused keyword (b)'])])
+
+    def test_duplicates(self):
+        analysed = []
+        checker = flake8_string_format.StringFormatChecker
+        check_template = checker.__dict__['_check_template']
+
+        def counting(self, template, shape):
+            analysed.append(template)
+            return check_template(self, template, shape)
+
+        checker._check_template = counting
+        self.addCleanup(setattr, checker, '_check_template', check_template)
+        results = list(flake8_string_format.check_templates(
+            ['{}', '{}', ('{}', (1,)), ('{}', (1,)), '{0}']))
+        self.assertEqual(analysed, ['{}', '{}', '{0}'])
+        self.assertEqual(results[0][1], results[1][1])
+        self.assertEqual(results[2][1], results[3][1])
+
+    def test_streaming(self):
+        def templates():
+            yield '{}'
+            raise ValueError
+
+        results = flake8_string_format.check_templates(templates())
+        self.assertEqual(next(results)[0], 0)
+        self.assertRaises(ValueError, next, results)
+
+
+def get_hunks(old_lines, new_lines):
+    """Return the hunks between both like in a unified diff."""
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    hunks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            hunks.append((i1 + 1 if i2 > i1 else i1, i2 - i1,
+                          j1 + 1 if j2 > j1 else j1, j2 - j1))
+    return hunks
+
+
+class TestIncremental(unittest.TestCase):
+
+    OLD = ['"""Module {}."""',
+           'x = "{}"',
+           'y = "{0} {1}".format(',
+           '    1)',
+           'def f():',
+           '    return "{}".format(1, 2)',
+           'z = "{}"']
+
+    def check(self, old_lines, new_lines):
+        checker = flake8_string_format.StringFormatChecker
+        previous = list(checker(ast.parse('\n'.join(old_lines)), 'fn').run())
+        new_tree = ast.parse('\n'.join(new_lines))
+        expected = sorted(checker(new_tree, 'fn').run(),
+                          key=lambda error: error[:2])
+        incremental = checker(new_tree, 'fn').run_incremental(
+            previous, get_hunks(old_lines, new_lines))
+        self.assertEqual(sorted(incremental), sorted(expected))
+
+    def test_edits(self):
+        old = self.OLD
+        self.check(old, old)
+        self.check(old, ['import os'] + old)
+        self.check(old, old[1:])
+        self.check(old, old[:2] + ['y = "{0} {1}".format(', '    1, 2)'] +
+                   old[4:])
+        self.check(old, old[:3] + ['    1,', '    2)'] + old[4:])
+        self.check(old, old[:4] + ['', '', 'w = "{}"'] + old[4:6])
+        self.check(old, old[:5] + ['    "{} Docstring"'] + old[5:])
+        self.check(old[:5] + ['    "{} Docstring"'] + old[5:], old)
+
+    def test_shift_line(self):
+        hunks = [(2, 1, 2, 3), (5, 0, 7, 2), (8, 2, 11, 0)]
+        self.assertEqual(
+            [flake8_string_format._shift_line(line, hunks)
+             for line in range(1, 12)],
+            [1, None, 5, 6, 7, 10, 11, None, None, 12, 13])
+
+    def test_end_lineno(self):
+        # Only Python 3.8 and newer store the last line of each node
+        call = ast.parse('"{0}".format(\n    1,\n    2)').body[0].value
+        self.assertEqual(flake8_string_format._get_end_lineno(call), 3)
+        self.assertEqual(
+            flake8_string_format._get_end_lineno(call.func.value), 1)
+
+    def test_only_changed_checked(self):
+        checked = []
+
+        class Checker(flake8_string_format.StringFormatChecker):
+
+            def _check_literal(self, literal, stats=None):
+                checked.append(literal.lineno)
+                return super(Checker, self)._check_literal(literal, stats)
+
+        new = self.OLD[:1] + ['x = "{0}"'] + self.OLD[2:]
+        Checker(ast.parse('\n'.join(new)), 'fn').run_incremental(
+            [], get_hunks(self.OLD, new))
+        self.assertEqual(checked, [1, 2])
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'stats.json')
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_stats_path', None)
+        checker._stats_path = self.path
+        self.addCleanup(setattr, checker, '_call_cache', checker._call_cache)
+        checker._call_cache = flake8_string_format._LRUCache(4096)
+
+    def test_report(self):
+        checker = flake8_string_format.StringFormatChecker
+        code = '"""Module."""\nx = "{}"\n"{0} {1}".format(42)\n'
+        for filename in ('a.py', 'b.py'):
+            list(checker(ast.parse(code), filename).run())
+        flake8_string_format.write_statistics_report(self.path)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        with open(self.path) as f:
+            report = json.load(f)
+        self.assertEqual(report['files'], 2)
+        self.assertEqual([record['filename'] for record in report['per_file']],
+                         ['a.py', 'b.py'])
+        self.assertEqual(report['totals']['literals'], 6)
+        self.assertEqual(report['totals']['calls'], 2)
+        # The call in the second file is the same as in the first
+        self.assertEqual(report['totals']['cached_calls'], 1)
+        self.assertEqual(report['call_cache_hit_rate'], 0.5)
+        self.assertLessEqual(report['totals']['parsed'], 4)
+        for record in report['per_file']:
+            self.assertEqual(record['literals'], 3)
+            self.assertGreaterEqual(record['traverse_time'], 0)
+
+
+class TestConstants(unittest.TestCase):
+
+    MESSAGES = (
+        'GREETING = "Hello {name}"\n'
+        'TWICE = "a"\n'
+        'TWICE = "b {0}"\n'
+        'class Errors(object):\n'
+        '    MISSING = "{0} is missing {1}"\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'pkg'))
+        self.write('pkg/__init__.py', 'PACKAGE = "{0}"\n')
+        self.write('pkg/messages.py', self.MESSAGES)
+        self.index = flake8_string_format._ConstantIndex()
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_constant_index', None)
+        checker._constant_index = self.index
+
+    def write(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+    def check(self, code):
+        filename = self.write('pkg/use.py', code)
+        checker = flake8_string_format.StringFormatChecker(
+            ast.parse(code), filename, code.splitlines(True))
+        return [(error[0], error[2][:6]) for error in checker.run()]
+
+    def test_local(self):
+        self.assertEqual(
+            self.check('A = "{0}"\n'
+                       'class B:\n'
+                       '    C = "{a}"\n'
+                       'A.format(1, 2)\n'
+                       'B.C.format()\n'
+                       'str.format(A)\n'
+                       'A.upper().format()\n'),
+            [(4, 'FMT301'), (5, 'FMT202'), (6, 'FMT201')])
+
+    def test_imported(self):
+        self.assertEqual(
+            self.check('from . import messages\n'
+                       'from .messages import GREETING, Errors\n'
+                       'import pkg.messages\n'
+                       'import pkg.messages as msgs\n'
+                       'GREETING.format(user=1)\n'
+                       'Errors.MISSING.format(1)\n'
+                       'messages.GREETING.format(name=1)\n'
+                       'pkg.messages.Errors.MISSING.format(1, 2, 3)\n'
+                       'msgs.GREETING.format()\n'
+                       'msgs.UNKNOWN.format()\n'
+                       'from . import PACKAGE\n'
+                       'PACKAGE.format()\n'),
+            [(5, 'FMT202'), (5, 'FMT302'), (6, 'FMT201'), (8, 'FMT301'),
+             (9, 'FMT202'), (12, 'FMT201')])
+
+    def test_not_constant(self):
+        self.assertEqual(
+            self.check('from pkg.messages import TWICE\n'
+                       'A = "{0}"\n'
+                       'B = "{0}"\n'
+                       'def f(A):\n'
+                       '    global B\n'
+                       '    B = "{a}"\n'
+                       '    return A.format()\n'
+                       'TWICE.format()\n'
+                       'B.format()\n'),
+            [])
+
+    def test_disabled(self):
+        flake8_string_format.StringFormatChecker._constant_index = None
+        self.assertEqual(self.check('A = "{0}"\nA.format()\n'), [])
+
+    def test_index_once(self):
+        path = os.path.join(self.directory, 'pkg', 'messages.py')
+        digest, constants = self.index.get(path)
+        self.assertEqual(constants, {'GREETING': 'Hello {name}',
+                                     'Errors.MISSING': '{0} is missing {1}'})
+        self.assertIs(self.index.get(path)[1], constants)
+        self.write('pkg/messages.py', 'GREETING = "{0}"\n')
+        self.assertEqual(self.index.get(path)[1], {'GREETING': '{0}'})
+
+    def test_find_module_once(self):
+        filename = os.path.join(self.directory, 'pkg', 'main.py')
+        path = self.index.find_module('messages', 1, filename)
+        self.assertEqual(path,
+                         os.path.join(self.directory, 'pkg', 'messages.py'))
+        self.index._find_module = None
+        self.assertEqual(self.index.find_module('messages', 1, filename),
+                         path)
+
+    def test_cached_by_hash(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+        cache = flake8_string_format._ResultCache(cache_dir, 10)
+        path = os.path.join(self.directory, 'pkg', 'messages.py')
+        constants = flake8_string_format._ConstantIndex(cache).get(path)[1]
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        collect = flake8_string_format._collect_constants
+        self.addCleanup(setattr, flake8_string_format, '_collect_constants',
+                        collect)
+        flake8_string_format._collect_constants = None
+        self.assertEqual(
+            flake8_string_format._ConstantIndex(cache).get(path)[1],
+            constants)
+
+    def test_result_cache_key(self):
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_result_cache', None)
+        checker._result_cache = flake8_string_format._ResultCache(
+            os.path.join(self.directory, 'cache'), 10)
+        code = 'from pkg.messages import GREETING\nGREETING.format()\n'
+        self.assertEqual(self.check(code), [(2, 'FMT202')])
+        self.write('pkg/messages.py', 'GREETING = "Hello"\n')
+        checker._constant_index = flake8_string_format._ConstantIndex()
+        self.assertEqual(self.check(code), [])
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_same_as_collected(self):
+        tree = ast.parse(dynamic_code)
+        streamed = list(
+            flake8_string_format.StringFormatChecker(tree, 'fn').run())
+        checker = flake8_string_format.StringFormatChecker(tree, 'fn')
+        visitor = flake8_string_format.TextVisitor()
+        visitor.visit(tree)
+        collected = [error for literal in visitor.literals
+                     for error in checker._check_literal(literal)]
+        self.assertEqual(streamed, collected)
+        self.assertTrue(streamed)
+
+    def test_errors_before_end(self):
+        tree = ast.parse('x = "{}"\n' + 'y = "{0}"\n' * 100)
+        visitor = flake8_string_format.TextVisitor()
+        literals = visitor.iter_literals(tree)
+        self.assertEqual(next(literals).value, '{}')
+        self.assertEqual(visitor.literals, [])
+
+    @unittest.skipIf(tracemalloc is None, 'requires tracemalloc')
+    def test_constant_memory(self):
+        checker = flake8_string_format.StringFormatChecker
+        for attribute in ('_parse_cache', '_field_kinds_cache'):
+            self.addCleanup(setattr, checker, attribute,
+                            getattr(checker, attribute))
+            setattr(checker, attribute, flake8_string_format._LRUCache(0))
+        peaks = []
+        for literals in (1000, 10000):
+            tree = ast.parse(benchmark.generate_source(literals, 0.5))
+            gc.collect()
+            tracemalloc.start()
+            try:
+                for _ in checker(tree, 'fn').run():
+                    pass
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+
+@unittest.skipIf(os.name != 'posix', 'requires fork')
+class TestSharding(unittest.TestCase):
+
+    SOURCE = (
+        '# -*- coding: latin-1 -*-\n'
+        '"""Module {}."""\n'
+        'from __future__ import unicode_literals\n'
+        '"{}"\n'
+        'x = 1; y = "{0}".format(1, 2)\n'
+        '@decorator("{}")\n'
+        'def function():\n'
+        '    """Function {}."""\n'
+        '    return b"{} \\xe4".format(1)\n'
+        'class Class(object):\n'
+        '    """Class {}."""\n'
+        '    message = "{name}".format(other=1)\n')
+
+    def setUp(self):
+        checker = flake8_string_format.StringFormatChecker
+        for attribute in ('_shard_lines', '_shard_jobs'):
+            self.addCleanup(setattr, checker, attribute,
+                            getattr(checker, attribute))
+        checker._shard_lines = 3
+        checker._shard_jobs = 2
+
+    def run_checker(self, source, sharded):
+        lines = source.splitlines(True)
+        checker = flake8_string_format.StringFormatChecker(
+            ast.parse(source), 'fn', lines)
+        if not sharded:
+            checker._shard_lines = 0
+        self.assertEqual(checker._is_sharded(), sharded)
+        return list(checker.run())
+
+    def test_split(self):
+        tree = ast.parse(self.SOURCE)
+        self.assertEqual(flake8_string_format._split_shards(tree, 3),
+                         [(0, 3), (3, 6), (6, 7)])
+        self.assertEqual(flake8_string_format._split_shards(tree, 100),
+                         [(0, 7)])
+
+    def test_identical(self):
+        serial = self.run_checker(self.SOURCE, False)
+        self.assertEqual(len(serial), 8)
+        self.assertEqual(self.run_checker(self.SOURCE, True), serial)
+
+    def test_generated(self):
+        source = benchmark.generate_source(300, 0.5)
+        self.assertEqual(self.run_checker(source, True),
+                         self.run_checker(source, False))
+
+    def test_whole_module(self):
+        checker = flake8_string_format.StringFormatChecker
+        self.addCleanup(setattr, checker, '_constant_index',
+                        checker._constant_index)
+        checker._constant_index = flake8_string_format._ConstantIndex()
+        self.run_checker(self.SOURCE, False)
+
+
+class TestEnabledCodes(unittest.TestCase):
+
+    def enabled(self, **kwargs):
+        options = optparse.Values(kwargs)
+        return flake8_string_format._get_enabled_codes(options)
+
+    def test_default(self):
+        all_codes = set(flake8_string_format.StringFormatChecker.ERRORS)
+        self.assertEqual(self.enabled(), all_codes)
+        self.assertEqual(self.enabled(select=['E', 'F', 'W', 'C90']),
+                         all_codes)
+
+    def test_select_and_ignore(self):
+        self.assertEqual(self.enabled(select=['FMT2']),
+                         set([201, 202, 203, 204, 205]))
+        self.assertEqual(self.enabled(select=['E'], extend_select=['FMT3']),
+                         set([301, 302]))
+        self.assertEqual(
+            self.enabled(ignore='FMT101,FMT102,FMT103,FMT2'), set([301, 302]))
+        self.assertEqual(self.enabled(select=['FMT1'], ignore=['FMT']),
+                         set([101, 102, 103]))
+
+
+class TestPruning(unittest.TestCase):
+
+    CODE = ('"""Module {}."""\n'
+            'x = "{}"\n'
+            '"{}".format(1, 2)\n'
+            '"{0}".format(1, a=2)\n')
+
+    def setUp(self):
+        checker = flake8_string_format.StringFormatChecker
+        for attribute in ('_enabled_codes', '_call_cache'):
+            self.addCleanup(setattr, checker, attribute,
+                            getattr(checker, attribute))
+        checker._call_cache = flake8_string_format._LRUCache(4096)
+        self.parsed = []
+        self.analysed = []
+        get_fields = checker.__dict__['get_fields']
+        analyse_call = checker.__dict__['_analyse_call']
+
+        def counting_get_fields(checker, string):
+            self.parsed.append(string)
+            return get_fields(checker, string)
+
+        def counting_analyse_call(checker, *args):
+            self.analysed.append(args[0])
+            return analyse_call(checker, *args)
+
+        for name, function in (('get_fields', counting_get_fields),
+                               ('_analyse_call', counting_analyse_call)):
+            self.addCleanup(setattr, checker, name, checker.__dict__[name])
+            setattr(checker, name, function)
+
+    def run_checker(self, enabled, code=CODE):
+        checker = flake8_string_format.StringFormatChecker
+        checker._enabled_codes = frozenset(enabled)
+        return [error[2][:6] for error in checker(ast.parse(code), 'fn').run()]
+
+    def test_all(self):
+        self.assertEqual(
+            self.run_checker(flake8_string_format.StringFormatChecker.ERRORS),
+            ['FMT102', 'FMT103', 'FMT101', 'FMT301', 'FMT302'])
+        self.assertEqual(len(self.parsed), 4)
+        self.assertEqual(len(self.analysed), 2)
+
+    def test_calls_only(self):
+        self.assertEqual(self.run_checker([201, 301, 302]),
+                         ['FMT101', 'FMT301', 'FMT302'])
+        self.assertEqual(self.parsed, ['{}', '{0}'])
+        self.assertEqual(len(self.analysed), 2)
+
+    def test_unindexed_only(self):
+        self.assertEqual(self.run_checker([101, 103]),
+                         ['FMT103', 'FMT101'])
+        self.assertEqual(self.parsed, ['{}', '{}', '{0}'])
+        self.assertEqual(self.analysed, [])
+
+    def test_docstrings_only(self):
+        self.assertEqual(self.run_checker([102]), ['FMT102'])
+        self.assertEqual(self.parsed, ['Module {}.'])
+
+    def test_nothing(self):
+        self.assertEqual(self.run_checker([]), [])
+        self.assertEqual(self.parsed, [])
+
+    def test_tokens(self):
+        checker = flake8_string_format.StringFormatChecker
+        checker._enabled_codes = frozenset([301, 302])
+        self.assertEqual([error[2][:6] for error in run_tokens(self.CODE)],
+                         ['FMT101', 'FMT301', 'FMT302'])
+        self.assertEqual(self.parsed, ['{}', '{0}'])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generated_source(self):
+        tree = ast.parse(benchmark.generate_source(100, 0.5))
+        self.assertEqual(len(benchmark.collect_texts(tree)), 101)
+
+    def test_baseline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        args = ['suite', '--files', '1', '--literals', '20', '--repeat', '1']
+        self.assertEqual(benchmark.main(args + ['--save-baseline', baseline]),
+                         0)
+        with open(baseline) as f:
+            metrics = json.load(f)
+        self.assertEqual(metrics['files'], 1)
+        self.assertEqual(metrics['literals'], 21)
+
+        metrics['run'] *= 2
+        self.assertEqual(benchmark.compare_baseline(metrics, metrics, 0.2),
+                         [])
+        slower = dict(metrics, run=metrics['run'] * 1.5)
+        self.assertEqual(len(benchmark.compare_baseline(slower, metrics, 0.2)),
+                         1)
+
+    def test_fuzz(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'fuzz.jsonl')
+        # The timings of a short run are too noisy to compare them
+        self.assertEqual(benchmark.main(
+            ['fuzz', '--templates', '300', '--repeat', '1', '--seed', '1',
+             '--tolerance', '100', '--output', output]), 0)
+        with open(output) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(len(results), 300)
+        self.assertTrue(all(result['match'] for result in results))
+        errors = sum(result['error'] for result in results)
+        self.assertTrue(0 < errors < 300)
+
+    def test_ascii_repr(self):
+        """Verify the templates are printed on a stdout only for ASCII."""
+        text = benchmark.ascii_repr('\xe4 {0} \u20ac \U0001f600')
+        text.encode('ascii')
+        self.assertIn('\\xe4', text)
+        self.assertIn('\\U0001f600', text)
+
+    def test_parse_importtime(self):
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       100 |        100 |     _string\n'
+            'import time:       200 |        300 |   string\n'
+            'import time:        50 |         50 |   atexit\n'
+            'import time:      1000 |       1350 | flake8_string_format\n'
+            'import time:         5 |          5 | json\n')
+        self.assertEqual(
+            benchmark.parse_importtime(output, 'flake8_string_format'),
+            (1000, 1350, {'string': 300, 'atexit': 50}))
+        self.assertIsNone(benchmark.parse_importtime(output, 'other'))
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'requires -X importtime')
+    def test_import_footprint(self):
+        """Verify the modules of optional features are imported lazily."""
+        self.assertEqual(benchmark.main(['importtime', '--repeat', '1']), 0)
+        imports = benchmark.measure_import('flake8_string_format', [])[2]
+        self.assertEqual(
+            set(imports) & set(['argparse', 'hashlib', 'json', 'optparse',
+                                'multiprocessing', 'socket', 'subprocess',
+                                'tempfile']), set())
+
+    def test_dispatch(self):
+        """Verify the strategies selected at import against the old code."""
+        tree = ast.parse(benchmark.generate_calls(40))
+        checker = flake8_string_format.StringFormatChecker(tree, 'fn')
+        for call in ast.walk(tree):
+            if not isinstance(call, ast.Call):
+                continue
+            str_args = not flake8_string_format._is_base_string(
+                call.func.value)
+            receiver = call.args[0] if str_args else call.func.value
+            self.assertTrue(flake8_string_format._is_base_string(receiver))
+            record = flake8_string_format._FormatCall(call, str_args)
+            self.assertEqual(
+                ((record.lineno, record.col_offset), record.num_args,
+                 record.keywords, record.has_starargs, record.has_kwargs),
+                benchmark.runtime_call_args(call, str_args))
+            text = flake8_string_format._get_text(receiver)
+            self.assertEqual(
+                checker._get_string(text, True),
+                benchmark.runtime_string(text, True))
+
+
+class CommandLineCaseBase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        checker = flake8_string_format.StringFormatChecker
+        for attribute in ('_mode', '_enabled_codes', '_result_cache',
+                          '_parse_cache', '_field_kinds_cache',
+                          '_call_cache', '_constant_index', '_stats_path',
+                          '_baseline', '_changes', '_shard_lines',
+                          '_shard_jobs'):
+            self.addCleanup(setattr, checker, attribute,
+                            getattr(checker, attribute))
+
+    def write(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+    def run_main(self, *args):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = six.StringIO(), six.StringIO()
+        try:
+            status = flake8_string_format.main(list(args))
+            return status, sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+class TestCommandLine(CommandLineCaseBase):
+
+    def test_check_file(self):
+        filename = self.write('a.py', 'x = "{}"\n'
+                                      'y = "{}"  # noqa\n'
+                                      'z = "{}"  # noqa: E501\n'
+                                      '"{0}".format(1, 2)  # noqa: FMT301\n')
+        self.assertEqual(
+            flake8_string_format.check_file(filename),
+            (filename, [
+                (1, 5, 'FMT103 other string does contain unindexed '
+                       'parameters'),
+                (3, 5, 'FMT103 other string does contain unindexed '
+                       'parameters')]))
+
+    def test_non_ascii_source(self):
+        """Python 2 byte strings with non-ASCII characters are checked."""
+        filename = os.path.join(self.directory, 'a.py')
+        with open(filename, 'wb') as f:
+            f.write(b'# -*- coding: utf-8 -*-\n'
+                    b'x = "caf\xc3\xa9"\n'
+                    b'y = "caf\xc3\xa9 {}"\n'
+                    b'z = "{0} \xc3\xa9 {a.b} {c[0]:{d}}".format(1, 2, a=3)\n')
+        checker = flake8_string_format.StringFormatChecker
+        for mode in ('ast', 'tokens'):
+            checker._mode = mode
+            self.assertEqual(
+                flake8_string_format.check_file(filename),
+                (filename, [
+                    (3, 5, 'FMT103 other string does contain unindexed '
+                           'parameters'),
+                    (4, 5, 'FMT202 format call uses missing keyword (c)'),
+                    (4, 5, 'FMT202 format call uses missing keyword (d)'),
+                    (4, 5, 'FMT301 format call provides unused index (1)')]))
+
+    def test_syntax_error(self):
+        filename = self.write('a.py', 'x = (\n')
+        _, errors = flake8_string_format.check_file(filename)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0][2].startswith('E999 SyntaxError'))
+
+    def test_main(self):
+        self.write('a.py', 'x = "{}"\n')
+        self.write('b.py', 'x = "{0}".format(1, 2)\n')
+        self.write('c.txt', 'x = "{}"\n')
+        for jobs in ('1', '2'):
+            status, output = self.run_main('-j', jobs, self.directory)
+            self.assertEqual(status, 1)
+            self.assertEqual(sorted(output), [
+                os.path.join(self.directory, 'a.py') +
+                ':1:5: FMT103 other string does contain unindexed parameters',
+                os.path.join(self.directory, 'b.py') +
+                ':1:5: FMT301 format call provides unused index (1)'])
+
+        status, output = self.run_main('-j1', '--first-error', self.directory)
+        self.assertEqual((status, len(output)), (1, 1))
+        self.assertEqual(self.run_main('-j1', '--ignore', 'FMT1,FMT3',
+                                       self.directory), (0, []))
+
+
+class TestBaseline(CommandLineCaseBase):
+
+    def test_write(self):
+        self.write('a.py', 'x = "{}"\nx = "{}"\n"{0}".format(1, 2)\n')
+        self.write('b.py', 'x = "{0}"\n')
+        baseline = os.path.join(self.directory, 'baseline.json')
+        self.assertEqual(
+            self.run_main('-j1', '--write-baseline', baseline, self.directory),
+            (0, ['Wrote 3 errors in 1 files to ' + baseline]))
+        with open(baseline) as f:
+            files = json.load(f)['files']
+        self.assertEqual(list(files), ['a.py'])
+        self.assertEqual(sorted(files['a.py'].values()), [1, 2])
+
+    def test_filter(self):
+        filename = self.write('a.py', 'x = "{}"\nx = "{}"\n'
+                                      '"{0}".format(1, 2)\n')
+        baseline = os.path.join(self.directory, 'baseline.json')
+        self.run_main('-j1', '--write-baseline', baseline, filename)
+        # The known errors moved and there are new ones on identical lines
+        self.write('a.py', 'import os\n\nx = "{}"\n"{0}".format(1, 2)\n'
+                           'x = "{}"\nx = "{}"\ny = "{}"\n')
+        for mode in ('ast', 'tokens'):
+            status, output = self.run_main('-j1', '--fmt-mode', mode,
+                                           '--fmt-baseline', baseline,
+                                           self.directory)
+            self.assertEqual(status, 1)
+            self.assertEqual(output, [
+                filename + ':6:5: FMT103 other string does contain '
+                           'unindexed parameters',
+                filename + ':7:5: FMT103 other string does contain '
+                           'unindexed parameters'])
+
+        # Writing a new baseline ignores the old one
+        self.run_main('-j1', '--fmt-baseline', baseline, '--write-baseline',
+                      baseline, filename)
+        self.assertEqual(self.run_main('-j1', '--fmt-baseline', baseline,
+                                       filename), (0, []))
+
+    def test_files_without_entries(self):
+        baseline = flake8_string_format._Baseline(
+            os.path.join(self.directory, 'baseline.json'))
+        baseline.add(os.path.join(self.directory, 'a.py'), ['x = "{}"\n'],
+                     [(1, 5, 'FMT103 other string')])
+        error = (1, 4, 'FMT103 other string', None)
+        # The lines of other files are not needed
+        self.assertEqual(
+            list(baseline.filter(os.path.join(self.directory, 'b.py'), None,
+                                 [error])), [error])
+        self.assertEqual(
+            list(baseline.filter(os.path.join(self.directory, 'a.py'),
+                                 ['  x = "{}"  \n'], [error])), [])
+
+    def test_version(self):
+        baseline = self.write('baseline.json', '{"version": 0, "files": {}}')
+        self.assertRaises(ValueError, flake8_string_format._Baseline.load,
+                          baseline)
+
+
+class TestChanges(CommandLineCaseBase):
+
+    def setUp(self):
+        super(TestChanges, self).setUp()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+        self.git('init', '-q')
+        self.write('a.py', 'x = "{}"\n"{0}".format(1, 2)\n\n\n'
+                           'y = (\n    "{}"\n)\n')
+        self.write('b.py', 'x = "{}"\n')
+        self.git('add', 'a.py', 'b.py')
+        self.git('commit', '-q', '-m', 'Initial')
+
+    def git(self, *args):
+        process = Popen(('git', '-c', 'user.name=Test', '-c',
+                         'user.email=test@example.com') + args,
+                        stdout=PIPE, stderr=PIPE)
+        process.communicate()
+        self.assertEqual(process.returncode, 0)
+
+    def test_ranges(self):
+        self.write('a.py', 'import os\nx = "{}"\n"{0}".format(1, 2)\n\n'
+                           'y = (\n    "{}"\n)\n')
+        self.write('c.py', 'x = "{}"\n')
+        changes = flake8_string_format._Changes('HEAD')
+        self.assertEqual(changes.get('a.py'), [(1, 1), (4, 5)])
+        self.assertEqual(changes.get('b.py'), [])
+        self.assertEqual(changes.get(os.path.join(self.directory, 'c.py')),
+                         flake8_string_format._WHOLE_FILE)
+
+    def test_special_names(self):
+        # git appends a tab to the first name and quotes the second one
+        names = ['a b.py', 'c"d.py', 'e.py']
+        for name in names:
+            self.write(name, 'x = "{}"\n')
+        self.git('add', *names)
+        self.git('commit', '-q', '-m', 'Names')
+        os.remove('a.py')
+        for name in names:
+            self.write(name, 'x = "{}"\ny = "{}"\n')
+        changes = flake8_string_format._Changes('HEAD')
+        for name in names:
+            self.assertEqual(changes.get(name), [(2, 2)])
+        self.assertEqual(changes.get('a.py'), [])
+        status, output = self.run_main('-j1', '--fmt-diff-base', 'HEAD', '.')
+        self.assertEqual(sorted(output), [
+            os.path.join('.', name) +
+            ':2:5: FMT103 other string does contain unindexed parameters'
+            for name in names])
+
+    def test_main(self):
+        # The call changed, but not the string in the last statement
+        self.write('a.py', 'x = "{}"\n"{0}".format(1, 2, 3)\n\n\n'
+                           'y = (\n    "{}"\n)  # comment\n')
+        self.write('c.py', 'x = "{}"\n')
+        for mode in ('ast', 'tokens'):
+            status, output = self.run_main('-j1', '--fmt-mode', mode,
+                                           '--fmt-diff-base', 'HEAD', '.')
+            self.assertEqual(status, 1)
+            self.assertEqual(output, [
+                os.path.join('.', 'a.py') +
+                ':2:1: FMT301 format call provides unused index (1)',
+                os.path.join('.', 'a.py') +
+                ':2:1: FMT301 format call provides unused index (2)',
+                os.path.join('.', 'c.py') +
+                ':1:5: FMT103 other string does contain unindexed parameters',
+            ])
+
+    def test_run(self):
+        # Only the line of the string in the last statement changed
+        self.write('a.py', 'x = "{}"\n"{0}".format(1, 2)\n\n\n'
+                           'y = (\n    "{}"  # comment\n)\n')
+        checker = flake8_string_format.StringFormatChecker
+        checker._changes = flake8_string_format._Changes('HEAD')
+        with open('a.py') as f:
+            lines = f.readlines()
+        errors = list(checker(ast.parse(''.join(lines)), './a.py',
+                              lines).run())
+        self.assertEqual([error[:2] for error in errors], [(6, 4)])
+        self.assertEqual(list(checker(ast.parse('x = "{}"'), 'b.py').run()),
+                         [])
+
+    def test_invalid_ref(self):
+        self.assertRaises(ValueError, flake8_string_format._Changes,
+                          'no-such-ref')
+
+    def test_daemon(self):
+        # The daemon would keep using the changes of its start
+        self.assertRaises(SystemExit, self.run_main, '--daemon',
+                          '--fmt-diff-base', 'HEAD')
+        self.assertIsNone(flake8_string_format.StringFormatChecker._changes)
+
+
+class TestDaemon(CommandLineCaseBase):
+
+    def request(self, daemon, *requests):
+        infile = io.BytesIO(b''.join(json.dumps(request).encode('utf-8') +
+                                     b'\n' for request in requests))
+        outfile = io.BytesIO()
+        stop = daemon.serve(infile, outfile)
+        return stop, [json.loads(line.decode('utf-8'))
+                      for line in outfile.getvalue().splitlines()]
+
+    def test_check(self):
+        filename = self.write('a.py', 'x = "{}"\n')
+        daemon = flake8_string_format._Daemon()
+        stop, responses = self.request(
+            daemon,
+            {'id': 1, 'method': 'check', 'params': {'filename': filename}},
+            {'id': 2, 'method': 'check',
+             'params': {'filename': filename, 'source': 'x = "{0}"\n'}},
+            {'id': 3, 'method': 'unknown'})
+        self.assertFalse(stop)
+        self.assertEqual(responses, [
+            {'id': 1, 'result': {'filename': filename, 'errors': [
+                [1, 5, 'FMT103 other string does contain unindexed '
+                       'parameters']]}},
+            {'id': 2, 'result': {'filename': filename, 'errors': []}},
+            {'id': 3, 'error': 'Invalid request'}])
+
+    def test_unchanged(self):
+        filename = self.write('a.py', 'x = "{}"\n')
+        daemon = flake8_string_format._Daemon()
+        errors = daemon.check(filename)
+        self.assertIs(daemon.check(filename), errors)
+        self.write('a.py', 'x = "{0}"\n')
+        self.assertEqual(daemon.check(filename), [])
+
+    def test_invalid(self):
+        infile = io.BytesIO(b'no json\n\n[]\n{"id": 4, "method": "shutdown"}\n'
+                            b'{"id": 5, "method": "shutdown"}\n')
+        outfile = io.BytesIO()
+        self.assertTrue(flake8_string_format._Daemon().serve(infile, outfile))
+        responses = [json.loads(line.decode('utf-8'))
+                     for line in outfile.getvalue().splitlines()]
+        self.assertEqual(len(responses), 3)
+        self.assertIsNone(responses[0]['id'])
+        self.assertIn('error', responses[1])
+        self.assertEqual(responses[2], {'id': 4, 'result': None})
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_socket(self):
+        filename = self.write('a.py', 'x = "{0}".format(1, 2)\n')
+        path = os.path.join(self.directory, 'daemon.sock')
+        self.assertEqual(self.run_main('--socket', path, filename)[0], 2)
+
+        daemon = flake8_string_format._Daemon()
+        thread = threading.Thread(target=daemon.serve_socket, args=(path,))
+        thread.start()
+        try:
+            while not os.path.exists(path):
+                thread.join(0.01)
+            for _ in range(2):
+                self.assertEqual(
+                    self.run_main('--socket', path, filename),
+                    (1, [filename + ':1:5: FMT301 format call provides '
+                                    'unused index (1)']))
+            self.assertEqual(list(daemon.results), [filename])
+        finally:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b'{"method": "shutdown"}\n')
+            client.makefile('rb').readline()
+            client.close()
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_socket_path_is_file(self):
+        path = self.write('a.py', 'x = "{}"\n')
+        self.assertEqual(self.run_main('--daemon', '--socket', path), (2, []))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'x = "{}"\n')
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+    def test_socket_in_use(self):
+        path = os.path.join(self.directory, 'daemon.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen(1)
+            self.assertEqual(self.run_main('--daemon', '--socket', path),
+                             (2, []))
+            self.assertTrue(os.path.exists(path))
+        finally:
+            server.close()
+
+        # The socket of the closed server is stale and replaced
+        daemon = flake8_string_format._Daemon()
+        thread = threading.Thread(target=daemon.serve_socket, args=(path,))
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            while True:
+                try:
+                    client.connect(path)
+                    break
+                except socket.error:
+                    thread.join(0.01)
+            client.sendall(b'{"method": "shutdown"}\n')
+            client.makefile('rb').readline()
+            client.close()
+        finally:
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+
+
 class ManualFileMetaClass(type):
 
     _SINGLE_REGEX = re.compile(r'(FMT\d\d\d)(?: +\((\d+)\))?')
@@ -270,6 +1619,8 @@ class OutputTestCase(TestCaseBase):
 
 class Flake8CaseBase(OutputTestCase):
 
+    options = []
+
     def run_test(self, positions, filename, content):
         # Either stdin or file
         assert filename is None or content is None
@@ -282,7 +1633,8 @@ class Flake8CaseBase(OutputTestCase):
             expected_filename = 'stdin'
             filename = '-'
             stdin = PIPE
-        p = Popen(['flake8', '--select=FMT', filename], env=env,
+        p = Popen(['flake8', '--select=FMT'] + self.options + [filename],
+                  env=env,
                   stdin=stdin, stdout=PIPE, stderr=PIPE)
         # TODO: Add possibility for timeout
         stdout, stderr = p.communicate(input=content)
@@ -302,6 +1654,16 @@ class TestFlake8Files(Flake8CaseBase):
         super(TestFlake8Files, self).run_test(positions, filename, None)
 
 
+@six.add_metaclass(ManualFileMetaClass)
+class TestFlake8Tokens(Flake8CaseBase):
+
+    options = ['--fmt-mode=tokens']
+
+    def run_test(self, positions, tree, filename):
+        """Test using the tokens only."""
+        super(TestFlake8Tokens, self).run_test(positions, filename, None)
+
+
 class TestFlake8StdinDynamic(Flake8CaseBase):
 
     def test_dynamic(self):
@@ -0,0 +1,30 @@
+# Error: FMT102
+"""Test docstring detection {}."""
+
+
+def function():
+    # Error: FMT102
+    """Function {} docstring."""
+    # Error: FMT103
+    return "{}"
+
+
+class Class(object):
+    # Error: FMT102
+    """Class {} docstring."""
+
+    def method(self):
+        """No fields."""
+        # Not a docstring and not formatted so it is skipped
+        "{}"
+
+
+# Error: FMT103
+@decorator("{}")
+def decorated():
+    # Error: FMT102
+    """Decorated {} docstring."""
+    # Error: FMT101
+    return "{}".format(
+        # Error: FMT103
+        "{}")